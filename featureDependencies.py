@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import json
+import stat
+import hashlib
+
+from featureFormatter import StatCache
+
+"""
+    Keep track of which .fea files include which, and which files
+    they are made from, to find out what has to be made again after a change.
+
+    The graph is kept in a json file in the feature dir. For each generated
+    file it has the files it includes and its inputs, the ufo or the script
+    it was made from. For every file it has the mtime, size and md5 from
+    the last time it was recorded. A file with the same mtime and size
+    has not changed, the md5 is only made again when the mtime changed,
+    so touching a file doesn't count as a change.
+
+        graph = IncludeGraph(dirName)
+        ff = FeatureFormatter(dirName, includeGraph=graph)
+        ff.addInput(ufoPath)
+        ...
+        ff.save("kern")
+        graph.save()
+
+        # later
+        for path in IncludeGraph(dirName).outdated():
+            print "make again", path
+
+    A directory, a ufo for instance, is compared by the newest mtime,
+    the number of files and the total size of what is inside.
+
+"""
+
+def _fileDigest(path):
+    md5 = hashlib.md5()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(2**20)
+            if not data:
+                break
+            md5.update(data)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
+def _directoryFingerprint(path, statCache):
+    newest = 0
+    count = 0
+    size = 0
+    for dirPath, dirNames, fileNames in os.walk(path):
+        for fileName in fileNames:
+            st = statCache.stat(os.path.join(dirPath, fileName))
+            if st is None:
+                continue
+            newest = max(newest, st.st_mtime)
+            count += 1
+            size += st.st_size
+    # the mtime goes in the last item too, a directory has no md5 to compare
+    return [newest, size, "%d files, newest %r"%(count, newest)]
+
+class IncludeGraph(object):
+    """
+
+        IncludeGraph object
+
+            dirName                         the dir with the .fea files, the paths are stored relative to it
+            fileName="feature_dependencies.json"    the file the graph is kept in
+
+        Stat calls are cached in statCache, a StatCache, until the next outdated(),
+        so a run of outdated() or a build looks at every file once.
+
+    """
+    def __init__(self, dirName, fileName="feature_dependencies.json"):
+        self.dirName = dirName
+        self.path = os.path.join(dirName, fileName)
+        self.files = {}         # generated path: dict(includes=[paths], inputs=[paths])
+        self.fingerprints = {}  # path: [mtime, size, md5]
+        self._changed = {}      # path: changed or not, for this run
+        self.statCache = StatCache()
+        if os.path.exists(self.path):
+            f = open(self.path)
+            data = json.load(f)
+            f.close()
+            for path, node in data["files"].items():
+                self.files[self._absolute(path)] = dict(
+                    includes=[self._absolute(p) for p in node["includes"]],
+                    inputs=[self._absolute(p) for p in node["inputs"]])
+            for path, fingerprint in data["fingerprints"].items():
+                self.fingerprints[self._absolute(path)] = fingerprint
+
+    def _absolute(self, path):
+        return os.path.normpath(os.path.abspath(os.path.join(self.dirName, path)))
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.dirName)
+
+    def save(self):
+        """ Write the graph to its json file. """
+        data = dict(
+            files=dict([(self._relative(path), dict(
+                includes=[self._relative(p) for p in node["includes"]],
+                inputs=[self._relative(p) for p in node["inputs"]]))
+                for path, node in self.files.items()]),
+            fingerprints=dict([(self._relative(path), fingerprint)
+                for path, fingerprint in self.fingerprints.items()]),
+            )
+        f = open(self.path, "w")
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.close()
+
+    def record(self, path, includes=(), inputs=()):
+        """ Remember a generated file, the files it includes and its inputs,
+            as they are now. Includes are relative to the dir of the file,
+            like the include() statement.
+        """
+        path = os.path.normpath(os.path.abspath(path))
+        base = os.path.dirname(path)
+        node = dict(
+            includes=[os.path.normpath(os.path.join(base, p)) for p in includes],
+            inputs=[os.path.normpath(os.path.abspath(p)) for p in inputs])
+        self.files[path] = node
+        for p in [path] + node["includes"] + node["inputs"]:
+            self.statCache.forget(p)
+            self._changed.pop(p, None)
+            self.fingerprints[p] = self._fingerprint(p, None)
+
+    def forget(self, path):
+        """ Forget a generated file. """
+        self.files.pop(os.path.normpath(os.path.abspath(path)), None)
+
+    def _fingerprint(self, path, previous):
+        """ [mtime, size, md5] of a file, or None if it is not there.
+            The md5 of the previous fingerprint is used if mtime and size are the same.
+        """
+        st = self.statCache.stat(path)
+        if st is None:
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            return _directoryFingerprint(path, self.statCache)
+        if previous is not None and previous[0] == st.st_mtime and previous[1] == st.st_size:
+            return previous
+        if previous is not None and previous[1] != st.st_size:
+            # a different size is a change, no need to read it
+            return [st.st_mtime, st.st_size, None]
+        return [st.st_mtime, st.st_size, _fileDigest(path)]
+
+    def changed(self, path):
+        """ True if the file is different from when it was recorded, or gone. """
+        result = self._changed.get(path)
+        if result is not None:
+            return result
+        previous = self.fingerprints.get(path)
+        current = self._fingerprint(path, previous)
+        if previous is None or current is None:
+            result = True
+        else:
+            result = current[1:] != previous[1:]
+            if not result and current[0] != previous[0]:
+                # touched, not changed. Don't read it again next time.
+                self.fingerprints[path] = current
+        self._changed[path] = result
+        return result
+
+    def outdated(self, paths=None):
+        """ The generated files that have to be made again, the included files
+            before the files that include them. A file is outdated when it is gone
+            or was edited, when one of its inputs changed, or when a file it includes
+            changed or is outdated itself. So a master file is outdated with its features.
+            paths limits the result to these files and what they include, a path that
+            was never recorded is outdated.
+        """
+        self._changed = {}
+        self.statCache = StatCache()
+        if paths is None:
+            paths = sorted(self.files)
+        else:
+            paths = [os.path.normpath(os.path.abspath(path)) for path in paths]
+        order = []
+        results = {}
+        for path in paths:
+            self._visit(path, results, order)
+        return [path for path in order if results[path] and (path in self.files or path in paths)]
+
+    def _visit(self, path, results, order):
+        """ Depth first, the includes are done before the file. """
+        if path in results:
+            return results[path]
+        results[path] = False   # a cycle doesn't make itself outdated
+        node = self.files.get(path)
+        if node is None:
+            # not generated, it only matters when it changed
+            result = self.changed(path)
+        else:
+            result = self.changed(path)
+            for inputPath in node["inputs"]:
+                if self.changed(inputPath):
+                    result = True
+            for includePath in node["includes"]:
+                if self._visit(includePath, results, order):
+                    result = True
+        results[path] = result
+        order.append(path)
+        return result
+
+    def dependents(self, path):
+        """ All the generated files that include path, directly or through other files. """
+        path = os.path.normpath(os.path.abspath(path))
+        includedBy = {}
+        for other, node in self.files.items():
+            for includePath in node["includes"]:
+                includedBy.setdefault(includePath, []).append(other)
+        found = set()
+        todo = [path]
+        while todo:
+            for other in includedBy.get(todo.pop(), []):
+                if other not in found:
+                    found.add(other)
+                    todo.append(other)
+        return sorted(found)
@@ -3,7 +3,15 @@
 
 import sys
 import os
-from time import strftime, localtime
+import re
+import shutil
+import hashlib
+from time import strftime, localtime, time
+from array import array
+from itertools import chain, izip
+from operator import itemgetter
+from tempfile import SpooledTemporaryFile
+from cStringIO import StringIO
 
 """
     A low level, non error checking formatter for .feature code text.
@@ -19,6 +27,597 @@ from time import strftime, localtime
     Erik van Blokland
 
 """
+class StatCache(object):
+    """ os.stat() of paths for one run, a build or an outdated() of an IncludeGraph,
+        so a file included by lots of features is only looked at once.
+        Make a new one for the next run, files come and go in between.
+    """
+    def __init__(self):
+        self._stats = {}
+
+    def stat(self, path):
+        """ os.stat() of the path, None if it is not there. """
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+        try:
+            result = os.stat(path)
+        except OSError:
+            result = None
+        self._stats[path] = result
+        return result
+
+    def forget(self, path=None):
+        """ Forget the stat of path, or of all paths. """
+        if path is None:
+            self._stats.clear()
+        else:
+            self._stats.pop(path, None)
+
+def feaFileName(featurePrefix, title):
+    return "feature_%s_%s.fea"%(featurePrefix, title)
+
+def _lookup(mapping, keys):
+    """ mapping[key] for each key, in one call. """
+    if len(keys) == 1:
+        return [mapping[keys[0]]]
+    return itemgetter(*keys)(mapping)
+
+def _asList(items):
+    """ Plain list from a list, tuple or numpy array. """
+    if hasattr(items, "tolist"):
+        return items.tolist()
+    return list(items)
+
+def compressKerning(pairs, tolerance=0.25):
+    """ Find the glyphs that kern (nearly) the same way and collect them in classes.
+        pairs is a dict with (firstName, secondName): value. Zero values are left out,
+        in flat kerning they don't do anything.
+
+        A glyph joins a class when its row (or column) of pairs differs from the row
+        of the class in no more than tolerance times the number of pairs, one pair
+        is always allowed. The value of a class pair is the value most glyph pairs of the
+        two classes have, the glyph pairs that differ are written as exceptions,
+        so the result is always equivalent. The classes are found through a few min
+        hashes of the pairs, no all against all.
+        Returns:
+            leftClasses     list of sorted lists of glyph names
+            rightClasses    same, for the second glyphs
+            rules           sorted list of (leftClassIndex, rightClassIndex, value)
+            exceptions      sorted list of (firstName, secondName, value)
+    """
+    rows = {}
+    columns = {}
+    for (first, second), value in pairs.items():
+        if not value:
+            continue
+        rows.setdefault(first, []).append((second, value))
+        columns.setdefault(second, []).append((first, value))
+    leftClasses = _kerningClasses(rows, tolerance)
+    rightClasses = _kerningClasses(columns, tolerance)
+    leftIndex = _classIndex(leftClasses)
+    rightIndex = _classIndex(rightClasses)
+    # count the values in each pair of classes, the rest of the glyph pairs are zero
+    counts = {}
+    for (first, second), value in pairs.items():
+        if not value:
+            continue
+        valueCounts = counts.setdefault((leftIndex[first], rightIndex[second]), {})
+        valueCounts[value] = valueCounts.get(value, 0) + 1
+    cells = {}
+    for (leftClass, rightClass), valueCounts in counts.items():
+        zeros = len(leftClasses[leftClass])*len(rightClasses[rightClass]) - sum(valueCounts.values())
+        count, value = max([(count, value) for value, count in valueCounts.items()])
+        if count > zeros:
+            cells[leftClass, rightClass] = value
+    exceptions = {}
+    for (first, second), value in pairs.items():
+        if value and cells.get((leftIndex[first], rightIndex[second]), 0) != value:
+            exceptions[first, second] = value
+    # glyph pairs without kerning in a class pair with kerning
+    for (leftClass, rightClass), value in cells.items():
+        if sum(counts[leftClass, rightClass].values()) == len(leftClasses[leftClass])*len(rightClasses[rightClass]):
+            continue
+        for first in leftClasses[leftClass]:
+            for second in rightClasses[rightClass]:
+                if not pairs.get((first, second)):
+                    exceptions[first, second] = 0
+    rules = sorted((leftClass, rightClass, value) for (leftClass, rightClass), value in cells.items())
+    exceptions = sorted((first, second, value) for (first, second), value in exceptions.items())
+    return leftClasses, rightClasses, rules, exceptions
+
+# a min hash for each multiplier, the candidate classes of a glyph share one of them
+_kerningHashMultipliers = [0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f, 0x165667b19e3779f9, 0xff51afd7ed558ccd]
+_kerningHashMask = 0xffffffffffffffff
+
+def _kerningClasses(vectors, tolerance):
+    """ Group names with identical (otherName, value) vectors, then put each group
+        in the closest bigger class it is close enough to, or start a new class.
+        Returns the sorted classes.
+    """
+    bySignature = {}
+    for name, vector in vectors.items():
+        vector.sort()
+        bySignature.setdefault(tuple(vector), []).append(name)
+    # biggest groups first, they become the classes the others can join
+    groups = sorted(bySignature.items(), key=lambda item: (-len(item[1]), min(item[1])))
+    buckets = {}
+    classes = []
+    profiles = []
+    for signature, names in groups:
+        hashes = [hash(item) for item in signature]
+        keys = [(multiplier, min([itemHash*multiplier & _kerningHashMask for itemHash in hashes]))
+            for multiplier in _kerningHashMultipliers]
+        target = None
+        best = None
+        seen = set()
+        for key in keys:
+            for index in buckets.get(key, ()):
+                if index in seen:
+                    continue
+                seen.add(index)
+                profile = profiles[index]
+                # a different value counts once, a missing pair on either side too
+                distance = len(profile)
+                for otherName, value in signature:
+                    if otherName not in profile:
+                        distance += 1
+                    elif profile[otherName] == value:
+                        distance -= 1
+                if distance > max(1, tolerance*max(len(signature), len(profile))):
+                    continue
+                if best is None or distance < best:
+                    target = index
+                    best = distance
+        if target is not None:
+            classes[target].extend(names)
+            continue
+        index = len(classes)
+        classes.append(list(names))
+        profiles.append(dict(signature))
+        for key in keys:
+            buckets.setdefault(key, []).append(index)
+    classes = [sorted(names) for names in classes]
+    classes.sort()
+    return classes
+
+def _classIndex(classes):
+    index = {}
+    for classIndex, names in enumerate(classes):
+        for name in names:
+            index[name] = classIndex
+    return index
+
+_ligatureAnchorPattern = re.compile(r"^(.+)_(\d+)$")
+
+def _orderLigatures(rules):
+    """ Order the ligatures of one first glyph, rules is a dict with components: ligatureName.
+        Rules with the same ligature that only differ in the last component are merged,
+        the last component becomes a tuple of names.
+        The rules go in a trie, walked depth first with the children before the node,
+        so a ligature that starts with another comes before it.
+        Returns the list of (components, ligatureName) and the number of merged rules.
+    """
+    byStart = {}
+    for components, ligatureName in rules.items():
+        byStart.setdefault((components[:-1], ligatureName), []).append(components[-1])
+    trie = {}
+    classes = 0
+    for (start, ligatureName), lasts in byStart.items():
+        if len(lasts) > 1:
+            lasts.sort()
+            last = tuple(lasts)
+            classes += 1
+        else:
+            last = lasts[0]
+        node = trie
+        for component in start[1:] + (last,):
+            node = node.setdefault(component, {})
+        node[None] = (start + (last,), ligatureName)
+    ordered = []
+    # a class is always at the end, the glyphs go first so their longer ligatures
+    # are written before the class
+    key = lambda component: (type(component) is tuple, component)
+    stack = [(trie, sorted([k for k in trie if k is not None], key=key, reverse=True))]
+    while stack:
+        node, children = stack[-1]
+        if children:
+            child = node[children.pop()]
+            stack.append((child, sorted([k for k in child if k is not None], key=key, reverse=True)))
+            continue
+        stack.pop()
+        if None in node:
+            ordered.append(node[None])
+    return ordered, classes
+
+class _SubtableSize(object):
+    """ Rough estimate of the compiled size of a lookup subtable in bytes.
+        Close enough to see a 16 bit offset overflow coming, it is not a compiler.
+    """
+    valueRecordSize = 4     # <x 0 x 0> has an x placement and an x advance
+
+    def __init__(self):
+        self.rules = 0
+        self.pairBytes = 0
+        self.otherBytes = 0
+        self.firstGlyphs = set()
+        self.firstClasses = set()
+        self.secondClasses = set()
+        self.classGlyphs = 0
+        self.oversized = []     # first classes that don't fit in a subtable on their own
+
+    def addPair(self, first, second, groupSizes):
+        self.rules += 1
+        if first[:1] == "@" or second[:1] == "@":
+            if first not in self.firstClasses:
+                self.firstClasses.add(first)
+                self.classGlyphs += groupSizes.get(first, 1)
+            if second not in self.secondClasses:
+                self.secondClasses.add(second)
+                self.classGlyphs += groupSizes.get(second, 1)
+        else:
+            if first not in self.firstGlyphs:
+                # coverage entry, pair set offset and count
+                self.firstGlyphs.add(first)
+                self.pairBytes += 6
+            # second glyph and the value record
+            self.pairBytes += 2 + self.valueRecordSize
+
+    def addOther(self, size):
+        self.rules += 1
+        self.otherBytes += size
+
+    def size(self):
+        classBytes = 0
+        if self.firstClasses:
+            # a value record for every class pair, class 0 is everything else.
+            # coverage and class definitions take about 4 bytes per glyph.
+            classBytes = 16 + (len(self.firstClasses)+1)*(len(self.secondClasses)+1)*self.valueRecordSize + 4*self.classGlyphs
+        return 10 + self.pairBytes + classBytes + self.otherBytes
+
+# kinds of lines in the _LineStore
+TEXT, COMMENT, BLOCK, KERN, KERNLIST = range(5)
+
+class _LineStore(object):
+    """ Compact storage for the lines of a FeatureFormatter.
+        Lines are kept as runs: a kind, an indent level and a count in small arrays.
+        Text and comment lines keep their text without the indent, a block is
+        text with lines that were formatted in one go. Kerning lines only keep
+        the indexes of the interned glyph names and the value, in integer arrays.
+        A kerning list from kernArrays() keeps its three lists as they are, in texts,
+        that is the fastest way in and out. The text of the lines is made when they are written.
+    """
+    __slots__ = ["indentSpace", "runKinds", "runIndents", "runCounts", "texts",
+            "kernFirst", "kernSecond", "kernValue", "names", "nameIndex", "size"]
+
+    def __init__(self, indentSpace):
+        self.indentSpace = indentSpace
+        self.runKinds = array("B")
+        self.runIndents = array("B")
+        self.runCounts = array("i")
+        self.texts = []
+        self.kernFirst = array("i")
+        self.kernSecond = array("i")
+        self.kernValue = array("i")
+        self.names = []
+        self.nameIndex = {}
+        self.size = 0
+
+    def add(self, indent, kind, text, count=1):
+        """ Add a text, comment or block line. count is the number of lines in a block. """
+        self.runKinds.append(kind)
+        self.runIndents.append(indent)
+        self.runCounts.append(1)
+        self.texts.append(text)
+        self.size += count
+
+    def addKernLists(self, indent, firstNames, secondNames, values):
+        """ Kerning lines from three lists, the store keeps the lists. """
+        count = len(values)
+        if not count:
+            return
+        self.runKinds.append(KERNLIST)
+        self.runIndents.append(indent)
+        self.runCounts.append(count)
+        self.texts.append((firstNames, secondNames, values))
+        self.size += count
+
+    def addKernPair(self, indent, firstName, secondName, value):
+        """ A kerning line, the names are interned and kept as indexes. """
+        nameIndex = self.nameIndex
+        first = nameIndex.get(firstName)
+        if first is None:
+            first = self._addName(firstName)
+        second = nameIndex.get(secondName)
+        if second is None:
+            second = self._addName(secondName)
+        self.kernFirst.append(first)
+        self.kernSecond.append(second)
+        self.kernValue.append(int(value))
+        if self.runKinds and self.runKinds[-1] == KERN and self.runIndents[-1] == indent:
+            self.runCounts[-1] += 1
+        else:
+            self.runKinds.append(KERN)
+            self.runIndents.append(indent)
+            self.runCounts.append(1)
+        self.size += 1
+
+    def _addName(self, name):
+        index = self.nameIndex[name] = len(self.names)
+        if type(name) is str:
+            name = intern(name)
+        self.names.append(name)
+        return index
+
+    def lastKind(self):
+        return self.runKinds[-1]
+
+    def appendToLast(self, text):
+        """ Add text to the end of the last line. With a # in the text the line becomes a comment. """
+        kind = self.runKinds[-1]
+        isComment = "#" in text
+        if kind == BLOCK and isComment:
+            # the last line of the block becomes a comment line, its indent is in the text
+            head, newline, last = self.texts[-1].rpartition("\n")
+            if newline:
+                self.texts[-1] = head
+                self.size -= 1
+                self.add(0, COMMENT, last+text)
+                return
+            self.runIndents[-1] = 0
+        if kind not in (KERN, KERNLIST):
+            if isComment:
+                self.runKinds[-1] = COMMENT
+            self.texts[-1] += text
+            return
+        # the last kerning line becomes a text line
+        if kind == KERN:
+            value = self.kernValue.pop()
+            firstName = self.names[self.kernFirst.pop()]
+            secondName = self.names[self.kernSecond.pop()]
+        else:
+            firstNames, secondNames, values = self.texts[-1]
+            value = values.pop()
+            firstName = firstNames.pop()
+            secondName = secondNames.pop()
+        line = "pos %s %s <%4d 0 %4d 0>;"%(firstName, secondName, value, value)
+        indent = self.runIndents[-1]
+        if self.runCounts[-1] == 1:
+            self.runKinds.pop()
+            self.runIndents.pop()
+            self.runCounts.pop()
+            if kind == KERNLIST:
+                self.texts.pop()
+        else:
+            self.runCounts[-1] -= 1
+        self.size -= 1
+        if isComment:
+            self.add(indent, COMMENT, line+text)
+        else:
+            self.add(indent, TEXT, line+text)
+
+    def write(self, f, chunkSize, keepLast=False):
+        """ Write the lines to an open file object, each with a newline in front.
+            keepLast leaves out the last line.
+        """
+        textIndex = 0
+        kernIndex = 0
+        prefixes = {}
+        valueTexts = {}     # value: its text, for all kerning lines
+        out = []
+        last = len(self.runKinds)-1
+        for run in xrange(len(self.runKinds)):
+            kind = self.runKinds[run]
+            if keepLast and run == last and kind not in (KERN, KERNLIST):
+                break
+            indent = self.runIndents[run]
+            prefix = prefixes.get(indent)
+            if prefix is None:
+                prefix = prefixes[indent] = "\n" + indent*self.indentSpace
+            if kind == KERN:
+                end = kernIndex + self.runCounts[run]
+                if keepLast and run == last:
+                    end -= 1
+                f.write("".join(out))
+                out = []
+                names = self.names
+                head = prefix + "pos "
+                firstTexts = dict([(first, head + names[first] + " ") for first in set(self.kernFirst[kernIndex:end])])
+                for start in xrange(kernIndex, end, chunkSize):
+                    stop = min(start+chunkSize, end)
+                    f.write(self._kernText(
+                        _lookup(firstTexts, self.kernFirst[start:stop]),
+                        _lookup(names, self.kernSecond[start:stop]),
+                        self.kernValue[start:stop], valueTexts))
+                kernIndex = end
+            elif kind == KERNLIST:
+                firstNames, secondNames, values = self.texts[textIndex]
+                textIndex += 1
+                end = self.runCounts[run]
+                if keepLast and run == last:
+                    end -= 1
+                f.write("".join(out))
+                out = []
+                head = prefix + "pos "
+                firstTexts = dict([(first, head + first + " ") for first in set(firstNames)])
+                for start in xrange(0, end, chunkSize):
+                    stop = min(start+chunkSize, end)
+                    f.write(self._kernText(_lookup(firstTexts, firstNames[start:stop]),
+                        secondNames[start:stop], values[start:stop], valueTexts))
+            elif kind == BLOCK:
+                out.append("\n")
+                out.append(self.texts[textIndex])
+                textIndex += 1
+            else:
+                out.append(prefix)
+                out.append(self.texts[textIndex])
+                textIndex += 1
+            if len(out) > chunkSize:
+                f.write("".join(out))
+                out = []
+        f.write("".join(out))
+
+    def _kernText(self, firstTexts, secondNames, values, valueTexts):
+        """ Kerning lines from the start of each line, up to the second name, the second
+            names and the values. First names and values repeat a lot, each one is formatted
+            once: firstTexts are made for each run, valueTexts keeps the values of all runs.
+        """
+        for value in set(values):
+            if value not in valueTexts:
+                valueTexts[value] = " <%4d 0 %4d 0>;"%(value, value)
+        # the pieces of all lines in one list, joining is faster than a template
+        count = len(values)
+        parts = [None]*(3*count)
+        parts[0::3] = firstTexts
+        parts[1::3] = secondNames
+        parts[2::3] = _lookup(valueTexts, values)
+        return "".join(parts)
+
+    def keepLast(self):
+        """ Forget everything but the last line, the rest has been written. """
+        kind = self.runKinds[-1]
+        indent = self.runIndents[-1]
+        if kind == KERNLIST:
+            firstNames, secondNames, values = self.texts[-1]
+            self.texts = [(firstNames[-1:], secondNames[-1:], values[-1:])]
+            del self.kernFirst[:]
+            del self.kernSecond[:]
+            del self.kernValue[:]
+        elif kind == KERN:
+            self.texts = []
+            del self.kernFirst[:-1]
+            del self.kernSecond[:-1]
+            del self.kernValue[:-1]
+        else:
+            self.texts = self.texts[-1:]
+            del self.kernFirst[:]
+            del self.kernSecond[:]
+            del self.kernValue[:]
+        self.runKinds = array("B", [kind])
+        self.runIndents = array("B", [indent])
+        self.runCounts = array("i", [1])
+        self.size = 1
+
+class _HashWriter(object):
+    """ File-like object that only keeps the md5 of what is written to it. """
+    def __init__(self):
+        self._md5 = hashlib.md5()
+
+    def write(self, text):
+        self._md5.update(text)
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+class _ListWriter(object):
+    """ File-like object that keeps what is written to it in a list, joined once at the end. """
+    def __init__(self):
+        self.parts = []
+        self.write = self.parts.append
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+# lines that start with these are rules
+_ruleKeywords = frozenset(["sub", "substitute", "rsub", "reversesub", "pos", "position",
+        "enum", "enumerate", "ignore", "markClass"])
+# lines that start with these don't refer to glyphs
+_structureKeywords = frozenset(["feature", "lookup", "table", "languagesystem", "script",
+        "language", "lookupflag", "include", "subtable", "}", "{", "ligComponent"])
+# words in rules that are not glyph or group names
+_ruleWords = frozenset(["sub", "substitute", "rsub", "reversesub", "pos", "position",
+        "enum", "enumerate", "ignore", "markClass", "by", "from", "mark", "base", "ligature",
+        "<anchor", "NULL>", "=", "[", "]", ";", "];"])
+
+class ScopeStats(object):
+    """ What was written in a feature, lookup or table, or in the whole file.
+        Blocks with the same name are added up, count is the number of blocks.
+            lines               lines, the opening and closing lines included
+            rules               substitution and positioning rules, mark classes
+            glyphReferences     glyph and group names used in rules and groups
+            bytes               bytes of text, newlines included
+            time                seconds between the start and the end of the block
+    """
+    __slots__ = ["kind", "name", "count", "lines", "rules", "glyphReferences", "bytes", "time"]
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.count = 0
+        self.lines = 0
+        self.rules = 0
+        self.glyphReferences = 0
+        self.bytes = 0
+        self.time = 0.0
+
+    def asDict(self):
+        return dict([(key, getattr(self, key)) for key in self.__slots__])
+
+    def __repr__(self):
+        return "<ScopeStats %s %s: %d lines, %d rules, %d bytes, %.3fs>"%(self.kind, self.name, self.lines, self.rules, self.bytes, self.time)
+
+class EmissionStats(object):
+    """ Statistics of a FeatureFormatter, made with collectStats=True.
+            features, lookups, tables   dicts with name: ScopeStats
+            total                       ScopeStats for the whole body, header not included.
+                                        Its time is the time spent in the outermost blocks.
+        Rules in a lookup count for the lookup and for the feature it is in.
+    """
+    def __init__(self):
+        self.features = {}
+        self.lookups = {}
+        self.tables = {}
+        self.total = ScopeStats("total", None)
+        self.open = []      # (ScopeStats, start time) of the blocks we are in
+
+    def _scopes(self, kind):
+        return {"feature": self.features, "lookup": self.lookups, "table": self.tables}[kind]
+
+    def start(self, kind, name):
+        scopes = self._scopes(kind)
+        scope = scopes.get(name)
+        if scope is None:
+            scope = scopes[name] = ScopeStats(kind, name)
+        scope.count += 1
+        self.open.append((scope, time()))
+
+    def end(self, kind):
+        for i in range(len(self.open)-1, -1, -1):
+            scope, start = self.open[i]
+            if scope.kind == kind:
+                del self.open[i]
+                scope.time += time()-start
+                if not self.open:
+                    self.total.time += time()-start
+                return scope
+        return None
+
+    def count(self, lines, rules, references, nbytes):
+        for scope in chain((self.total,), [scope for scope, start in self.open]):
+            scope.lines += lines
+            scope.rules += rules
+            scope.glyphReferences += references
+            scope.bytes += nbytes
+
+    def asDict(self):
+        """ Plain dicts and lists, for json. """
+        return dict(
+            total=self.total.asDict(),
+            features=[scope.asDict() for scope in self.features.values()],
+            lookups=[scope.asDict() for scope in self.lookups.values()],
+            tables=[scope.asDict() for scope in self.tables.values()],
+            )
+
+    def report(self, key="bytes", limit=None):
+        """ Text table of the features, lookups and tables, biggest first. """
+        scopes = self.features.values() + self.lookups.values() + self.tables.values()
+        scopes.sort(key=lambda scope: -getattr(scope, key))
+        text = ["%-8s %-32s %10s %10s %12s %12s %9s"%("kind", "name", "lines", "rules", "references", "bytes", "seconds")]
+        for scope in [self.total] + scopes[:limit]:
+            text.append("%-8s %-32s %10d %10d %12d %12d %9.3f"%(scope.kind, scope.name or "", scope.lines, scope.rules, scope.glyphReferences, scope.bytes, scope.time))
+        return "\n".join(text)
+
 class FeatureFormatter(object):
     """
     
@@ -28,8 +627,39 @@ class FeatureFormatter(object):
             featurePrefix="AT"      the name pattern will be "feature_<prefix>_<liga abbreviations>(or)<your own>.fea"     
             startIndent=1           the indent to start with
             includeTimeStamp=True   True will include a readable timestamp. Nicer to read, but will confuse svn. 
+            timeStamp=None          seconds since the epoch to use in the timestamp, None is the time of writing.
             indentSpace=" "*4       whitespace filler of choice
             verbose=False           True will print a couple of things more.
+            stream=None             True will write the body to a spooled temporary file as it is emitted,
+                                    so the lines don't all have to stay in memory. Or pass an open
+                                    file object (mode "w+") to use as the body buffer.
+            spoolSize=2**23         bytes the spooled buffer keeps in memory before it moves to disk.
+            flushSize=1000          lines to collect before they are written to the stream.
+            kernChunkSize=4096      kerning lines to format in one go when the text is written.
+            autoSubtable=False      True will estimate the compiled size of each lookup and insert
+                                    a subtable break in pair positioning before it gets too big.
+                                    Class pairs only break before a new first class, the pairs
+                                    of a first class in a later subtable would never apply.
+                                    See oversizedClasses() for the classes that don't fit alone.
+            subtableLimit=0xFFFF    the size, in bytes, a subtable has to stay under.
+            subtableMargin=0.1      break this fraction below the limit, the estimate is rough.
+            registerGroups=False    True will write each distinct glyph list only once. A group with
+                                    a list that is already known becomes a reference to the first group,
+                                    so does a sequence. See groupReport().
+            glyphSet=None           glyph names, with a glyph set the glyph and group names given to
+                                    addGroup(), kern(), markClass() and the mark methods are checked.
+                                    See validationReport().
+            knownGroups=None        names of groups defined elsewhere, in an included file for instance.
+            includeGraph=None       an IncludeGraph (see featureDependencies.py), save() records
+                                    the file with its includes and inputs in it.
+            statCache=None          a StatCache to share with other formatters of the same run,
+                                    None gets one for this formatter.
+            collectStats=False      True counts the lines, rules, glyph references, bytes and time of
+                                    each feature, lookup and table in stats, an EmissionStats object.
+
+        The lines are stored compactly and made into text when they are written. lines is
+        a tuple of that text now, it can't be changed: use addLine() and addLastLine()
+        instead of lines.append() or lines[-1] += text.
 
     """
     def __init__(self,
@@ -37,23 +667,71 @@ class FeatureFormatter(object):
             featurePrefix="AT",     
             startIndent=1,
             includeTimeStamp=True,
+            timeStamp=None,
             indentSpace=" "*4,
             verbose=False,
+            stream=None,
+            spoolSize=2**23,
+            flushSize=1000,
+            kernChunkSize=4096,
+            autoSubtable=False,
+            subtableLimit=0xFFFF,
+            subtableMargin=0.1,
+            registerGroups=False,
+            glyphSet=None,
+            knownGroups=None,
+            includeGraph=None,
+            statCache=None,
+            collectStats=False,
             ):
         self.dirName = dirName
         self.verbose = verbose
         self.flags = {}     # place to store simple flags so we can check if we have written certain things.
         self.featurePrefix = featurePrefix
         self.includeTimeStamp = includeTimeStamp
+        self.timeStamp = timeStamp
         self.indentLevel = 0
         self.indentSpace = indentSpace
-        self.lines = []
+        self._store = _LineStore(indentSpace)
         self.header = []
         self.featureNames = []
         self.structure = []
         self.currentFeature = None
         self.currentLookup = None
         self.currentTableName = None
+        self.lineCount = 0
+        self.flushSize = flushSize
+        self.kernChunkSize = kernChunkSize
+        self.autoSubtable = autoSubtable
+        self.subtableLimit = subtableLimit
+        self.subtableMargin = subtableMargin
+        self.groupSizes = {}
+        self._lookupSizes = {}
+        self._lookupSizeOrder = []
+        self.registerGroups = registerGroups
+        self.groupRegistry = {}     # tuple of glyph names: "@groupName"
+        self._registeredNames = {}  # "@groupName": tuple of glyph names
+        self._groupScopes = [[]]    # group names defined in each feature or lookup block
+        self._groupReport = dict(defined=0, references=0, aliases=0, namesSaved=0)
+        self.validate = glyphSet is not None
+        self._validNames = frozenset(glyphSet or [])
+        self._knownGroups = set(["@"+n.lstrip("@") for n in knownGroups or []])
+        self._unknownNames = {}     # name: line numbers in the body
+        self.includes = []      # file names given to include()
+        self.inputs = []        # paths given to addInput()
+        self.includeGraph = includeGraph
+        if statCache is None:
+            statCache = StatCache()
+        self.statCache = statCache
+        self.stats = None
+        if collectStats:
+            self.stats = EmissionStats()
+        self._listeners = []
+        self._stream = None
+        if stream is True:
+            self._stream = SpooledTemporaryFile(max_size=spoolSize, mode="w+")
+        elif stream:
+            self._stream = stream
         self.indent(startIndent)
     
     def indent(self, steps=1):
@@ -68,11 +746,35 @@ class FeatureFormatter(object):
     def startFeature(self, name):
         """ Start a new feature, start with trailing whiteline."""
         self.addStructure("feature %s {"%name)
+        self._startScope("feature", name)
         self.addLine("feature %s {"%name)
         self.currentFeature = name
         self.featureNames.append(name)
         self.indent()
+        self._groupScopes.append([])
     
+    def _startScope(self, kind, name):
+        if self.stats is not None:
+            self.stats.start(kind, name)
+        for callback in self._listeners:
+            callback("start", kind, name)
+
+    def _endScope(self, kind, name):
+        if self.stats is not None:
+            self.stats.end(kind)
+        for callback in self._listeners:
+            callback("end", kind, name)
+
+    def subscribe(self, callback):
+        """ Call callback(event, kind, name) when a feature, lookup or table starts or ends.
+            event is "start" or "end", kind is "feature", "lookup" or "table".
+            The end is called after the closing line, so stats are up to date.
+        """
+        self._listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        self._listeners.remove(callback)
+
     def addStructure(self, *tags):
         for tag in tags:
             self.structure.append(self.indentLevel*self.indentSpace + tag)
@@ -82,28 +784,156 @@ class FeatureFormatter(object):
         self.dedent()
         self.addLine("} %s;"%(self.currentFeature))
         self.addStructure("} %s;"%(self.currentFeature))
+        self._endScope("feature", self.currentFeature)
         self.currentFeature = None
+        self._endGroupScope()
     
     def startLookup(self, name):
         self.addStructure("lookup "+name)
+        self._startScope("lookup", name)
         self.addLine("lookup %s {"%name)
         self.currentLookup = name
         #self.featureNames.append(name)
         self.indent()
+        self._groupScopes.append([])
     
     def endLookup(self):
         self.dedent()
         self.addLine("} %s;"%(self.currentLookup))
+        if self.autoSubtable and self.verbose:
+            for size in self._lookupSizes.get(self._sizeKey(), []):
+                if size.size() > self.subtableLimit:
+                    print "lookup %s: a subtable of about %d bytes is over the limit"%(self.currentLookup, size.size())
+                for className in size.oversized:
+                    print "lookup %s: the pairs of %s don't fit in one subtable"%(self.currentLookup, className)
+        self._endScope("lookup", self.currentLookup)
         self.currentLookup = None
+        self._endGroupScope()
+
+    def subtable(self):
+        """ Add a subtable break. """
+        self.addLine("subtable;")
+        if self.autoSubtable:
+            self._currentSize()
+            self._lookupSizes[self._sizeKey()].append(_SubtableSize())
+
+    def _sizeKey(self):
+        """ Rules outside a lookup go to the lookup the compiler makes for the feature. """
+        if self.currentLookup is not None:
+            return "lookup %s"%self.currentLookup
+        return "feature %s"%self.currentFeature
+
+    def _currentSize(self):
+        key = self._sizeKey()
+        if key not in self._lookupSizes:
+            self._lookupSizes[key] = [_SubtableSize()]
+            self._lookupSizeOrder.append(key)
+        return self._lookupSizes[key][-1]
+
+    def _estimatePair(self, firstName, secondName):
+        """ Count the pair in the size of the current subtable.
+            Return True if there should be a subtable break before it.
+            A class pair only breaks before a first class that is not in the subtable yet,
+            a first class that doesn't fit on its own is listed in oversized.
+        """
+        size = self._currentSize()
+        newFirst = firstName not in size.firstClasses
+        size.addPair(firstName, secondName, self.groupSizes)
+        if size.rules < 2 or size.size() <= self.subtableLimit*(1-self.subtableMargin):
+            return False
+        if firstName not in size.firstClasses or newFirst:
+            return True
+        if firstName not in size.oversized:
+            size.oversized.append(firstName)
+        return False
+
+    def _estimateOther(self, nbytes):
+        """ Count a rule that is not a pair, marks for instance.
+            Compilers ignore subtable breaks in these lookups, so they are only counted.
+        """
+        self._currentSize().addOther(nbytes)
+
+    def lookupSizeEstimates(self):
+        """ List of (lookup, [estimated bytes for each subtable]) in the order they were written.
+            Rules written in a feature, outside a lookup, are listed as "feature <name>".
+        """
+        return [(key, [size.size() for size in self._lookupSizes[key]])
+                for key in self._lookupSizeOrder if self._lookupSizes[key][0].rules]
+
+    def oversizedClasses(self):
+        """ List of (lookup, first class) for the first classes with more class pairs
+            than fit in one subtable. They are not split, so the subtable is over the limit.
+        """
+        return [(key, className) for key in self._lookupSizeOrder
+                for size in self._lookupSizes[key] for className in size.oversized]
 
     def addLine(self, *args):
         """ Add all the items to the line, at the current indent."""
-        self.lines.append(self.indentLevel*self.indentSpace + " ".join(args))
+        text = " ".join(args)
+        if "#" in text:
+            self._addText(COMMENT, text)
+        else:
+            self._addText(TEXT, text)
+
+    def _addText(self, kind, text):
+        self._store.add(self.indentLevel, kind, text)
+        self.lineCount += 1
+        if self.stats is not None:
+            self._countText(kind, text, 1 + self.indentLevel*len(self.indentSpace) + len(text))
+        if self._stream is not None and self._store.size > self.flushSize:
+            self.flush()
+
+    def _appendLine(self, text, count=1):
+        """ Store a block of count lines that were formatted in one go, indent included. """
+        self._store.add(self.indentLevel, BLOCK, text, count)
+        self.lineCount += count
+        if self.stats is not None:
+            lines = text.split("\n")
+            self._countText(TEXT, lines[0], len(text) + 1)
+            for line in lines[1:]:
+                self._countText(TEXT, line, 0)
+        if self._stream is not None and self._store.size > self.flushSize:
+            self.flush()
+
+    def _countText(self, kind, text, nbytes):
+        """ Count a line in the stats. A line is a rule when it starts with a rule keyword,
+            the other words are glyph or group names, unless it is an anchor or a number.
+        """
+        rules = references = 0
+        words = text.split()
+        if kind == TEXT and words and words[0] not in _structureKeywords:
+            rules = int(words[0] in _ruleKeywords)
+            if words[1:2] == ["="]:
+                # the name of a group definition is not a reference
+                words = words[2:]
+            for word in words:
+                if word in _ruleWords or word[:1] == "<" or word[-1:] == ">":
+                    continue
+                word = word.strip("[];'")
+                if word and not word.lstrip("-").isdigit():
+                    references += 1
+        self.stats.count(1, rules, references, nbytes)
+
+    def flush(self):
+        """ In streaming mode, write all lines but the last to the stream.
+            The last line stays, addLastLine() and endMarks() might still change it.
+        """
+        if self._stream is None or self._store.size < 2:
+            return
+        self._store.write(self._stream, self.kernChunkSize, keepLast=True)
+        self._store.keepLast()
+
+    @property
+    def lines(self):
+        """ The lines that are not in the stream yet, as a tuple of text. """
+        f = StringIO()
+        self._store.write(f, self.kernChunkSize)
+        return tuple(f.getvalue().split("\n")[1:])
     
     def comment(self, *args):
         """ Add a comment. """
         for commentLine in args:
-            self.addLine("# " + str(commentLine))
+            self._addText(COMMENT, "# " + str(commentLine))
         
     def title(self, *args):
         """ bigger looking comment. Titles are also added to the structure."""
@@ -118,7 +948,9 @@ class FeatureFormatter(object):
     def addLastLine(self, text):
         """ Append the text to the previous line. """
         if not self.lastLineIsComment():
-            self.lines[-1]+=text
+            self._store.appendToLast(text)
+            if self.stats is not None:
+                self.stats.count(0, 0, 0, len(text))
         else:
             self.addLine(text)
     
@@ -146,6 +978,19 @@ class FeatureFormatter(object):
             comment=False
             ):
         """ Format a group or sequence. """
+        if self.validate:
+            self._checkNames(glyphNames)
+            if groupName:
+                self._knownGroups.add("@"+groupName.lstrip("@"))
+        if self.registerGroups:
+            glyphNames = [n.strip() for n in glyphNames]
+            if sort:
+                glyphNames.sort()
+                sort = False
+            if self._registerGroup(glyphNames, groupName):
+                return
+        if groupName:
+            self.groupSizes["@"+groupName.lstrip("@")] = len(glyphNames)
         # format the group nicely so that editors won't choke
         if len(glyphNames) < 5:
             self._addSmallGroup(glyphNames, groupName)
@@ -188,6 +1033,74 @@ class FeatureFormatter(object):
         else:
             self.addLine("]")
     
+    def _registerGroup(self, glyphNames, groupName):
+        """ Keep track of the glyph lists we have written.
+            Return True if a reference was written instead of the list.
+        """
+        key = tuple(glyphNames)
+        known = self.groupRegistry.get(key)
+        if not groupName:
+            if known is None:
+                return False
+            # a sequence we already have a group for
+            self.addLine(known)
+            self._groupReport["references"] += 1
+            self._groupReport["namesSaved"] += len(key)
+            return True
+        name = "@"+groupName.lstrip("@")
+        if known == name:
+            # same name, same glyphs, nothing to write
+            self._groupReport["aliases"] += 1
+            self._groupReport["namesSaved"] += len(key)
+            return True
+        previous = self._registeredNames.get(name)
+        self._registeredNames[name] = key
+        if previous is not None and self.groupRegistry.get(previous) == name:
+            # the name gets a new list, an alias can take over the old one
+            self._forgetGroup(previous)
+        self._groupScopes[-1].append(name)
+        if known is not None:
+            self._addSmallGroup([known], name)
+            self.groupSizes[name] = len(key)
+            self._groupReport["aliases"] += 1
+            self._groupReport["namesSaved"] += len(key)-1
+            return True
+        self.groupRegistry[key] = name
+        self._groupReport["defined"] += 1
+        return False
+
+    def _endGroupScope(self):
+        """ Groups defined in a feature or lookup block can't be used outside it. """
+        if len(self._groupScopes) < 2:
+            return
+        for name in self._groupScopes.pop():
+            key = self._registeredNames.pop(name, None)
+            if key is not None and self.groupRegistry.get(key) == name:
+                self._forgetGroup(key)
+
+    def _forgetGroup(self, key):
+        del self.groupRegistry[key]
+        for name, other in self._registeredNames.items():
+            if other == key:
+                self.groupRegistry[key] = name
+                break
+
+    def groupReference(self, glyphNames):
+        """ Return a registered group name for the glyph list, or the list as a [ ] sequence. """
+        if self.registerGroups:
+            known = self.groupRegistry.get(tuple(glyphNames))
+            if known is not None:
+                self._groupReport["references"] += 1
+                self._groupReport["namesSaved"] += len(glyphNames)
+                return known
+        return "[ %s ]"%" ".join(glyphNames)
+
+    def groupReport(self):
+        """ Dict with the number of groups defined, sequences written as a reference,
+            groups written as an alias and the number of glyph names that were not written.
+        """
+        return dict(self._groupReport)
+
     def languageSystem(self, name=None, code=None):
         """ Add a language system declaration. """
         if name == None:
@@ -205,8 +1118,17 @@ class FeatureFormatter(object):
         """ Include a filename. Check if it exists."""
         path = os.path.join(self.dirName, fileName)
         self.addLine("include(%s);"%fileName)
-        if not os.path.exists(path):
+        self.includes.append(fileName)
+        if self.statCache.stat(path) is None:
             self.comment("Note: missing file at", path)
+
+    def addInput(self, *paths):
+        """ Note the files this feature is made from, a ufo or a data file.
+            An IncludeGraph uses them to see if the feature needs to be made again.
+        """
+        for path in paths:
+            if path not in self.inputs:
+                self.inputs.append(path)
     
     def anchor(self, pos=None):
         if pos is None:
@@ -216,20 +1138,32 @@ class FeatureFormatter(object):
     def markClass(self, glyphName, pos, className):
         """markClass aShadda_aDamma <anchor 130 404> @MARK_TOP_ACCENTS;
         """
+        if self.validate:
+            self._checkNames((glyphName,))
+            self._knownGroups.add(className)
         self.addLine("markClass %s %s %s;"%(glyphName, self.anchor(pos), className))
     
     def positionMark(self, glyphName, pos, className):
         """ define a mark class
             position mark aDamma <anchor 129 668> mark @MARK_TOP_ACCENTS;
         """
+        if self.validate:
+            self._checkNames((glyphName, className))
         self.addLine("position mark %s %s mark %s;"%(glyphName, self.anchor(pos), className))
+        if self.autoSubtable:
+            # coverage, record offset and the anchor
+            self._estimateOther(10)
 
     def startLigatureMarks(self, ligatureName):
         """ start the definition of a mark to ligature construct
             position ligature...
         """
+        if self.validate:
+            self._checkNames((ligatureName,))
         self.addLine("position ligature %s"%ligatureName)
         self.indent()
+        if self.autoSubtable:
+            self._estimateOther(6)
 
     def positionBaseMark(self, name, pos, className):
         """ definition of a mark to base
@@ -250,8 +1184,12 @@ class FeatureFormatter(object):
             prefix="#"
         else:
             prefix=""
+        if self.validate and enable:
+            self._checkNames((ligatureName,))
         self.addLine(prefix+"position base %s"%ligatureName)
         self.indent()
+        if self.autoSubtable and enable:
+            self._estimateOther(4)
     
     def anchorBasePosition(self, pos, className, enable=True):
         """ define an anchor in a glyph, part of mark to base, or mark to ligature.
@@ -262,15 +1200,186 @@ class FeatureFormatter(object):
             prefix="#"
         else:
             prefix=""
+        if self.validate and enable:
+            self._checkNames((className,))
         self.addLine(prefix+"%s mark %s"%(self.anchor(pos), className))
+        if self.autoSubtable and enable:
+            # anchor offset and the anchor
+            self._estimateOther(8)
     
     def kern(self, firstName, secondName, value):
-        self.addLine("pos %s %s <%4d 0 %4d 0>;"%(firstName, secondName, value, value))
-    
+        if self.autoSubtable and self._estimatePair(firstName, secondName):
+            self.subtable()
+            self._estimatePair(firstName, secondName)
+        if self.validate:
+            self._checkNames((firstName, secondName))
+        self._store.addKernPair(self.indentLevel, firstName, secondName, value)
+        self.lineCount += 1
+        if self.stats is not None:
+            self.stats.count(1, 1, 2, 7 + self.indentLevel*len(self.indentSpace) + len(firstName) + len(secondName)
+                    + len("<%4d 0 %4d 0>;"%(value, value)))
+        if self._stream is not None and self._store.size > self.flushSize:
+            self.flush()
+
+    def kernPairs(self, pairs, sort=False, dropZero=False, threshold=None):
+        """ Add a whole table of kerning pairs in one call.
+            pairs is a dict with (firstName, secondName): value,
+            or a sequence of (firstName, secondName, value) items.
+            See kernArrays() for the other arguments.
+        """
+        if hasattr(pairs, "items"):
+            # keys() and values() come in the same order
+            keys = pairs.keys()
+            values = pairs.values()
+        else:
+            keys = pairs
+            values = map(itemgetter(2), pairs)
+        firstNames = map(itemgetter(0), keys)
+        secondNames = map(itemgetter(1), keys)
+        return self.kernArrays(firstNames, secondNames, values, sort, dropZero, threshold)
+
+    def kernArrays(self, firstNames, secondNames, values, sort=False, dropZero=False, threshold=None):
+        """ Add kerning pairs from parallel sequences of names and values. Numpy arrays are fine.
+            The output is the same as calling kern() for each pair, but the lists
+            are kept as they are until the lines are written, in chunks of kernChunkSize.
+                sort        True sorts the pairs by first, then second name.
+                            Or a key function for (firstName, secondName, value) items.
+                dropZero    True skips the pairs with value 0.
+                threshold   skip the pairs with abs(value) smaller than the threshold.
+            Returns the number of pairs written.
+        """
+        firstNames = _asList(firstNames)
+        secondNames = _asList(secondNames)
+        values = _asList(values)
+        if dropZero or threshold is not None:
+            keep = [i for i, value in enumerate(values)
+                    if (value or not dropZero) and (threshold is None or abs(value) >= threshold)]
+            firstNames = [firstNames[i] for i in keep]
+            secondNames = [secondNames[i] for i in keep]
+            values = [values[i] for i in keep]
+        if sort:
+            if sort is True:
+                key = None
+            else:
+                key = sort
+            items = sorted(izip(firstNames, secondNames, values), key=key)
+            firstNames = map(itemgetter(0), items)
+            secondNames = map(itemgetter(1), items)
+            values = map(itemgetter(2), items)
+        if self.autoSubtable:
+            start = 0
+            for i in xrange(len(values)):
+                if self._estimatePair(firstNames[i], secondNames[i]):
+                    self._writeKernLines(firstNames[start:i], secondNames[start:i], values[start:i])
+                    self.subtable()
+                    self._estimatePair(firstNames[i], secondNames[i])
+                    start = i
+            self._writeKernLines(firstNames[start:], secondNames[start:], values[start:])
+        else:
+            self._writeKernLines(firstNames, secondNames, values)
+        return len(values)
+
+    def _writeKernLines(self, firstNames, secondNames, values):
+        if self.validate:
+            # only look at the pairs one by one when there is something wrong
+            unknown = self._unknownIn(set(firstNames) | set(secondNames))
+            if unknown:
+                for i, pair in enumerate(izip(firstNames, secondNames)):
+                    for name in pair:
+                        if name in unknown:
+                            self._unknownNames.setdefault(name, []).append(self.lineCount+i+1)
+        self._store.addKernLists(self.indentLevel, firstNames, secondNames, values)
+        self.lineCount += len(values)
+        if self.stats is not None and values:
+            valueBytes = dict([(value, len("<%4d 0 %4d 0>;"%(value, value))) for value in set(values)])
+            count = len(values)
+            self.stats.count(count, count, 2*count, count*(7 + self.indentLevel*len(self.indentSpace))
+                    + sum(map(len, firstNames)) + sum(map(len, secondNames)) + sum(map(valueBytes.__getitem__, values)))
+        if self._stream is not None and self._store.size > self.flushSize:
+            self.flush()
+
+    def kernClasses(self, pairs, groupPrefix="kern", tolerance=0.25):
+        """ Write flat pair kerning as class kerning.
+            Glyphs that kern nearly the same are collected with compressKerning(),
+            classes with more than one glyph are written with addGroup() as
+            @<groupPrefix>1_<first glyph> and @<groupPrefix>2_<first glyph>.
+            Glyph pairs and exceptions are written first, then the class pairs.
+            Returns a dict with the number of pairs, rules, exceptions, groups and rules saved.
+        """
+        leftClasses, rightClasses, rules, exceptions = compressKerning(pairs, tolerance)
+        leftNames = self._writeKernClasses(leftClasses, groupPrefix+"1")
+        rightNames = self._writeKernClasses(rightClasses, groupPrefix+"2")
+        glyphRules = []
+        classRules = []
+        for leftIndex, rightIndex, value in rules:
+            rule = (leftNames[leftIndex], rightNames[rightIndex], value)
+            if len(leftClasses[leftIndex]) == 1 and len(rightClasses[rightIndex]) == 1:
+                glyphRules.append(rule)
+            else:
+                classRules.append(rule)
+        self.kernPairs(sorted(glyphRules + exceptions))
+        self.kernPairs(classRules)
+        pairCount = len([value for value in pairs.values() if value])
+        ruleCount = len(rules) + len(exceptions)
+        report = dict(
+            pairs=pairCount,
+            rules=ruleCount,
+            exceptions=len(exceptions),
+            groups=len([n for n in leftClasses+rightClasses if len(n) > 1]),
+            saved=pairCount-ruleCount,
+            )
+        if self.verbose:
+            print "class kerning: %(pairs)d pairs in %(rules)d rules and %(groups)d groups, %(saved)d rules saved"%report
+        return report
+
+    def _writeKernClasses(self, classes, prefix):
+        """ Add groups for the classes with more than one glyph.
+            Return the names to use in the rules, either a group or a glyph name.
+        """
+        names = []
+        for glyphNames in classes:
+            if len(glyphNames) == 1:
+                names.append(glyphNames[0])
+            else:
+                groupName = "@%s_%s"%(prefix, glyphNames[0])
+                self.addGroup(glyphNames, groupName)
+                names.append(groupName)
+        return names
+
+    def _checkNames(self, names):
+        """ Remember the glyph and group names that are not in the glyph set,
+            and the line they are on.
+        """
+        for name in self._unknownIn(names):
+            self._unknownNames.setdefault(name, []).append(self.lineCount+1)
+
+    def _unknownIn(self, names):
+        unknown = set()
+        for name in names:
+            if name in self._validNames or name in self._knownGroups:
+                continue
+            if name[:1] == "[":
+                # an inline sequence
+                unknown.update(self._unknownIn(name.strip("[] ").split()))
+            else:
+                unknown.add(name)
+        return unknown
+
+    def validationReport(self):
+        """ List of (name, [line numbers]) for the names that are not in the glyph set,
+            or groups that were not defined, in the order they were first used.
+            The line numbers are the lines in the saved file.
+        """
+        offset = len(self._headerLines())
+        report = [(name, [offset+line for line in lines]) for name, lines in self._unknownNames.items()]
+        report.sort(key=lambda item: item[1][0])
+        return report
+
     def lastLineIsComment(self):
         """ Return True if the last line is a comment. """
-        if self.lines[-1].find("#")!=-1:
-            print "comment?", self.lines[-1]
+        if self._store.lastKind() == COMMENT:
+            if self.verbose:
+                print "comment?", self.lines[-1]
             return True
         return False
 
@@ -282,7 +1391,9 @@ class FeatureFormatter(object):
         """
         self.dedent()
         if not self.lastLineIsComment():
-            self.lines[-1]+=";"
+            self._store.appendToLast(";")
+            if self.stats is not None:
+                self.stats.count(0, 0, 0, 1)
         else:
             self.addLine(";")
     
@@ -290,8 +1401,227 @@ class FeatureFormatter(object):
         self.dedent()
         self.addLine("ligComponent")
         self.indent()
+        if self.autoSubtable:
+            self._estimateOther(2)
     
+    def markAttachments(self, glyphNames, anchorNames, xs, ys,
+            classPrefix="MC_",
+            markFeature="mark",
+            mkmkFeature="mkmk",
+            ):
+        """ Write the mark classes, mark to base, mark to ligature and mark to mark
+            of a whole font in one go. The anchors come in columns, one row per anchor:
+            glyphNames, anchorNames, xs and ys are sequences (or numpy arrays) of the same length.
+                "_top"      makes the glyph a mark in class @<classPrefix>top
+                "top"       makes the glyph a base for those marks, or a mark to mark base
+                "top_1"     the top anchor of the first component of a ligature
+            Bases, and marks in mkmk, with exactly the same anchors share one statement.
+            markFeature or mkmkFeature None will leave that feature out.
+            Returns a dict with the number of classes, marks, bases, ligatures and statements.
+        """
+        glyphs = {}
+        for glyphName, anchorName, x, y in izip(_asList(glyphNames), _asList(anchorNames), _asList(xs), _asList(ys)):
+            glyphs.setdefault(glyphName, {})[anchorName] = (x, y)
+        if self.validate:
+            self._checkNames(glyphs.keys())
+        markClasses = {}
+        for glyphName, anchors in glyphs.items():
+            for anchorName, pos in anchors.items():
+                if anchorName[:1] == "_":
+                    markClasses.setdefault(anchorName[1:], {})[glyphName] = pos
+        marks = set()
+        for members in markClasses.values():
+            marks.update(members)
+        bases = {}
+        markBases = {}
+        ligatures = []
+        for glyphName in sorted(glyphs):
+            attach = []
+            components = {}
+            for anchorName, pos in glyphs[glyphName].items():
+                if anchorName in markClasses:
+                    attach.append((anchorName, pos))
+                    continue
+                m = _ligatureAnchorPattern.match(anchorName)
+                if m is not None and m.group(1) in markClasses:
+                    components.setdefault(int(m.group(2)), []).append((m.group(1), pos))
+            if glyphName in marks:
+                if attach:
+                    markBases.setdefault(tuple(sorted(attach)), []).append(glyphName)
+            elif components:
+                ligatures.append((glyphName, [sorted(components.get(i, [])) for i in range(1, max(components)+1)]))
+            elif attach:
+                bases.setdefault(tuple(sorted(attach)), []).append(glyphName)
+
+        anchorTexts = {}
+        def attachText(prefix, attach):
+            lines = []
+            for className, pos in attach:
+                text = anchorTexts.get(pos)
+                if text is None:
+                    text = anchorTexts[pos] = self.anchor(pos)
+                lines.append("%s%s mark @%s%s"%(prefix, text, classPrefix, className))
+            return lines
+
+        statements = 0
+        prefix = self.indentLevel*self.indentSpace
+        for className in sorted(markClasses):
+            if self.validate:
+                self._knownGroups.add("@%s%s"%(classPrefix, className))
+            byPosition = {}
+            for glyphName, pos in markClasses[className].items():
+                byPosition.setdefault(pos, []).append(glyphName)
+            lines = []
+            for pos, members in sorted(byPosition.items()):
+                members.sort()
+                lines.append("%smarkClass %s %s @%s%s;"%(prefix, self._glyphList(members), self.anchor(pos), classPrefix, className))
+            self._appendLine("\n".join(lines), len(lines))
+            statements += len(lines)
+        if markFeature and (bases or ligatures):
+            self.startFeature(markFeature)
+            prefix = self.indentLevel*self.indentSpace
+            inner = prefix + self.indentSpace
+            for attach, members in sorted(bases.items(), key=lambda item: item[1][0]):
+                lines = ["%sposition base %s"%(prefix, self._glyphList(members))] + attachText(inner, attach)
+                lines[-1] += ";"
+                self._appendLine("\n".join(lines), len(lines))
+                if self.autoSubtable:
+                    self._estimateOther(4+8*len(attach))
+            for glyphName, components in ligatures:
+                lines = ["%sposition ligature %s"%(prefix, glyphName)]
+                for i, attach in enumerate(components):
+                    if i:
+                        lines.append(prefix+"ligComponent")
+                    if attach:
+                        lines += attachText(inner, attach)
+                    else:
+                        lines.append(inner+self.anchor())
+                lines[-1] += ";"
+                self._appendLine("\n".join(lines), len(lines))
+                if self.autoSubtable:
+                    self._estimateOther(6+2*len(components)+8*sum([len(attach) for attach in components]))
+            statements += len(bases) + len(ligatures)
+            self.endFeature()
+        if mkmkFeature and markBases:
+            self.startFeature(mkmkFeature)
+            prefix = self.indentLevel*self.indentSpace
+            inner = prefix + self.indentSpace
+            for attach, members in sorted(markBases.items(), key=lambda item: item[1][0]):
+                if len(attach) == 1:
+                    lines = ["%sposition mark %s %s"%(prefix, self._glyphList(members), attachText("", attach)[0])]
+                else:
+                    lines = ["%sposition mark %s"%(prefix, self._glyphList(members))] + attachText(inner, attach)
+                lines[-1] += ";"
+                self._appendLine("\n".join(lines), len(lines))
+                if self.autoSubtable:
+                    self._estimateOther(2+8*len(attach))
+            statements += len(markBases)
+            self.endFeature()
+        return dict(
+            classes=len(markClasses),
+            marks=len(marks),
+            bases=sum([len(members) for members in bases.values()]),
+            ligatures=len(ligatures),
+            markBases=sum([len(members) for members in markBases.values()]),
+            statements=statements,
+            )
+
+    def _glyphList(self, glyphNames):
+        """ A single glyph name, or a sequence for more. """
+        if len(glyphNames) == 1:
+            return glyphNames[0]
+        return self.groupReference(glyphNames)
+
+    def ligatureSubstitutions(self, ligatures,
+            lookupName="ligatures",
+            marks=None,
+            flags=("IgnoreMarks",),
+            ):
+        """ Write a lot of ligature substitutions in one go.
+            ligatures is a dict with components: ligatureName, or a sequence of
+            (components, ligatureName) items. components is a tuple of glyph names,
+            or a string with the names separated by spaces.
+                lookupName  the name of the lookup, the rules go in the current feature.
+                marks       glyph names of the marks. Rules for a first glyph that has
+                            marks in one of its ligatures go in lookup <lookupName>_marks,
+                            without IgnoreMarks, so the marks can be matched.
+                flags       lookupflags for the lookup.
+            The rules are put in a trie for each first glyph, a ligature that starts
+            with another ligature is written before it, so the longest match wins.
+            Rules with the same ligature that differ only in the last component become
+            one rule with a class. With autoSubtable a lookup that gets too big is
+            continued in <lookupName>_2, _3 and so on, at the start of a new first glyph.
+            Returns a dict with the number of ligatures, rules, rules with a class and the lookup names.
+        """
+        if hasattr(ligatures, "items"):
+            ligatures = ligatures.items()
+        byFirst = {}
+        count = 0
+        for components, ligatureName in ligatures:
+            if isinstance(components, basestring):
+                components = components.split()
+            components = tuple(components)
+            if len(components) < 2:
+                raise ValueError("ligature %s needs at least two components"%ligatureName)
+            byFirst.setdefault(components[0], {})[components] = ligatureName
+            count += 1
+        if self.validate:
+            names = set()
+            for rules in byFirst.values():
+                for components, ligatureName in rules.items():
+                    names.update(components)
+                    names.add(ligatureName)
+            self._checkNames(names)
+        markNames = frozenset(marks or [])
+        plain = []
+        withMarks = []
+        for first in sorted(byFirst):
+            rules = byFirst[first]
+            if markNames and [components for components in rules if markNames.intersection(components)]:
+                withMarks.append(first)
+            else:
+                plain.append(first)
+        markFlags = [flag for flag in flags if flag != "IgnoreMarks"]
+        report = dict(ligatures=count, rules=0, classes=0, lookups=[])
+        for firsts, name, lookupFlags in ((plain, lookupName, flags), (withMarks, lookupName+"_marks", markFlags)):
+            if not firsts:
+                continue
+            parts = [[]]
+            size = 6
+            for first in firsts:
+                rules, classes = _orderLigatures(byFirst[first])
+                report["rules"] += len(rules)
+                report["classes"] += classes
+                if self.autoSubtable:
+                    # coverage glyph, ligature set offset and count, then each ligature with its offset
+                    setSize = 6 + sum([6 + 2*len(components) for components, ligatureName in rules])
+                    if parts[-1] and size + setSize > self.subtableLimit*(1-self.subtableMargin):
+                        parts.append([])
+                        size = 6
+                    size += setSize
+                parts[-1].append(rules)
+            for i, part in enumerate(parts):
+                partName = name
+                if i:
+                    partName = "%s_%d"%(name, i+1)
+                self.startLookup(partName)
+                if lookupFlags:
+                    self.lookupFlag(*lookupFlags)
+                prefix = self.indentLevel*self.indentSpace
+                for rules in part:
+                    lines = []
+                    for components, ligatureName in rules:
+                        components = [type(c) is tuple and self.groupReference(list(c)) or c for c in components]
+                        lines.append("%ssub %s by %s;"%(prefix, " ".join(components), ligatureName))
+                    self._appendLine("\n".join(lines), len(lines))
+                    if self.autoSubtable:
+                        self._estimateOther(6 + sum([6 + 2*len(components) for components, ligatureName in rules]))
+                self.endLookup()
+                report["lookups"].append(partName)
+        return report
+
     def startTable(self, name):
+        self._startScope("table", name)
         self.addLine("table %s {"%name)
         self.indent()
         self.currentTableName = name
@@ -299,33 +1629,93 @@ class FeatureFormatter(object):
     def endTable(self):
         self.dedent()
         self.addLine("} %s;"%self.currentTableName)
+        self._endScope("table", self.currentTableName)
         self.currentTableName = None
     
+    def _feaPath(self, optionalFileTitle=None):
+        if not optionalFileTitle:
+            optionalFileTitle = "_".join(self.featureNames)
+        return os.path.join(self.dirName, feaFileName(self.featurePrefix, optionalFileTitle))
+
     def save(self, optionalFileTitle=None):
         """Save the feature text of this feature to an external .fea file
         """
-        if not optionalFileTitle:
-            optionalFileTitle = "_".join(self.featureNames)
-        fileName = "feature_%s_%s.fea"%(self.featurePrefix, optionalFileTitle)
-        feaPath = os.path.join(self.dirName,fileName)
+        feaPath = self._feaPath(optionalFileTitle)
         if self.verbose:
             print "saving feature %s at %s"%(", ".join(self.featureNames), feaPath)
+            for name, lines in self.validationReport():
+                print "unknown name %s on line %s"%(name, ", ".join([str(line) for line in lines[:10]]))
         f = open(feaPath, 'w')
-        f.write(self.dump())
+        self.write(f)
         f.close()
+        self.statCache.forget(feaPath)
+        if self.includeGraph is not None:
+            self.includeGraph.record(feaPath, self.includes, self.inputs)
         return feaPath
-    
-    def dump(self):
-        """ Collect all the data and make a single string. """
+
+    def contentHash(self):
+        """ Hex md5 digest of the text, without the timestamp. """
+        h = _HashWriter()
+        self.write(h, includeTimeStamp=False)
+        return h.hexdigest()
+
+    def saveIfChanged(self, optionalFileTitle=None):
+        """ Save only if the text, ignoring the timestamp, is different from
+            what was saved last time. The hash of the saved text is kept in a
+            sidecar file next to the .fea: feature_<prefix>_<title>.fea.md5
+            Returns the path and True if the file was written, False if it was skipped.
+        """
+        feaPath = self._feaPath(optionalFileTitle)
+        hashPath = feaPath + ".md5"
+        digest = self.contentHash()
+        if os.path.exists(feaPath) and os.path.exists(hashPath):
+            f = open(hashPath, 'r')
+            previous = f.read().strip()
+            f.close()
+            if previous == digest:
+                if self.verbose:
+                    print "unchanged feature %s at %s"%(", ".join(self.featureNames), feaPath)
+                if self.includeGraph is not None:
+                    self.includeGraph.record(feaPath, self.includes, self.inputs)
+                return feaPath, False
+        self.save(optionalFileTitle)
+        f = open(hashPath, 'w')
+        f.write(digest)
+        f.close()
+        return feaPath, True
+
+    def _headerLines(self, includeTimeStamp=None):
+        """ The file structure, and the timestamp if we want one. """
+        if includeTimeStamp is None:
+            includeTimeStamp = self.includeTimeStamp
         text = []
         text.append("# file structure:")
         for line in self.structure:
             text.append("# %s%s"%(self.indentSpace, line))
-        if self.includeTimeStamp:
+        if self.registerGroups:
             text.append("")
-            text.append(strftime("# timestamp %a, %d %b %Y %H:%M:%S", localtime()))
-        text+=self.lines
-        return "\n".join(text)
+            text.append("# groups: %(defined)d defined, %(references)d references, %(aliases)d aliases, %(namesSaved)d glyph names saved"%self._groupReport)
+        if includeTimeStamp:
+            text.append("")
+            text.append(strftime("# timestamp %a, %d %b %Y %H:%M:%S", localtime(self.timeStamp)))
+        return text
+
+    def write(self, f, includeTimeStamp=None):
+        """ Write the header and all the lines to an open file object.
+            In streaming mode the body is copied from the stream in chunks.
+        """
+        f.write("\n".join(self._headerLines(includeTimeStamp)))
+        if self._stream is not None:
+            self._stream.seek(0)
+            shutil.copyfileobj(self._stream, f)
+            self._stream.seek(0, 2)
+        self._store.write(f, self.kernChunkSize)
+
+    def dump(self):
+        """ Collect all the data and make a single string. """
+        f = _ListWriter()
+        self.write(f)
+        return f.getvalue()
 
 if __name__ == "__main__":
     def test():
@@ -417,9 +1807,30 @@ if __name__ == "__main__":
         ff.startFeature("kern")
         ff.startLookup("arabicKern")
         ff.kern("firstName", "secondName", 100)
+        # lots of pairs in one go
+        ff.kernPairs({("firstName", "otherName"): -20, ("otherName", "secondName"): 0}, sort=True, dropZero=True)
         ff.endLookup()
         ff.endFeature()
     
         print "saved at", ff.dump()
 
+        # class kerning from a table of 10 by 10 classes with some noise:
+        # 100 class pairs, the noise as exceptions
+        import random
+        rnd = random.Random(1)
+        classValues = dict([((i, j), rnd.randint(-20, -1)*5) for i in range(10) for j in range(10)])
+        pairs = {}
+        noise = 0
+        for i in range(200):
+            for j in range(200):
+                value = classValues[i%10, j%10]
+                if rnd.random() < 0.05:
+                    value = rnd.choice([0, value+7, -123])
+                    noise += 1
+                pairs["left%d"%i, "right%d"%j] = value
+        leftClasses, rightClasses, rules, exceptions = compressKerning(pairs)
+        print "noisy kerning: %d classes, %d rules, %d exceptions for %d changed pairs"%(
+            len(leftClasses)+len(rightClasses), len(rules), len(exceptions), noise)
+        assert len(rules) == 100 and len(exceptions) <= noise
+
     test()
\ No newline at end of file
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import sys
+import time
+import json
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import traceback
+from multiprocessing import Process, Queue
+
+from featureFormatter import FeatureFormatter
+
+"""
+    Benchmarks for the FeatureFormatter at the scale of a big font.
+    No font editor needed, the glyph names and values are made up.
+
+    Each workload runs in its own process so the peak memory is its own,
+    --repeat times, the best times are reported.
+    For each workload we report the lines, the time to emit them,
+    the lines per second of emitting alone and of emitting and dump(),
+    the peak RSS, and the time for dump() and save().
+    Kerning from kernArrays() is only formatted when it is written,
+    so its lines per second without dump() are not the whole story.
+
+        python featureFormatterBenchmark.py
+        python featureFormatterBenchmark.py --output new.json --compare old.json
+        python featureFormatterBenchmark.py --scale 0.1 kernPairs marks
+        python featureFormatterBenchmark.py --check kern kernPairs
+
+    With both kern workloads the report has the speedup of kernArrays()
+    over a kern() call for each pair, for the emitting, with dump() and with save().
+    --check fails when emitting and save() together are less than
+    kernSpeedupGoal times faster, saving is what a build does.
+
+"""
+
+def _names(prefix, count):
+    return ["%s%05d"%(prefix, i) for i in range(count)]
+
+def _kernData(scale):
+    rnd = random.Random(500)
+    firsts = _names("first", 3000)
+    seconds = _names("second", 3000)
+    count = int(500000*scale)
+    return ([rnd.choice(firsts) for i in range(count)],
+            [rnd.choice(seconds) for i in range(count)],
+            [rnd.randrange(-200, 200, 5) for i in range(count)])
+
+# A workload gets the scale and makes its data,
+# then returns the function that writes it to a FeatureFormatter.
+# Only that function is timed.
+
+def workloadKern(scale):
+    """ 500k pairs, one kern() call each. """
+    pairs = zip(*_kernData(scale))
+    def emit(ff):
+        ff.startFeature("kern")
+        ff.startLookup("pairs")
+        for first, second, value in pairs:
+            ff.kern(first, second, value)
+        ff.endLookup()
+        ff.endFeature()
+    return emit
+
+def workloadKernPairs(scale):
+    """ 500k pairs in a single kernArrays() call. """
+    firstNames, secondNames, values = _kernData(scale)
+    def emit(ff):
+        ff.startFeature("kern")
+        ff.startLookup("pairs")
+        ff.kernArrays(firstNames, secondNames, values)
+        ff.endLookup()
+        ff.endFeature()
+    return emit
+
+def workloadGroups(scale):
+    """ Groups of 10k names through addGroup(). """
+    names = _names("glyph", 10000)
+    def emit(ff):
+        for i in range(max(1, int(50*scale))):
+            ff.addGroup(names, "group_%d"%i)
+    return emit
+
+def workloadMarks(scale):
+    """ Mark to base and mark to ligature, one call at a time. """
+    return lambda ff: _emitMarks(ff, scale)
+
+def _emitMarks(ff, scale):
+    rnd = random.Random(10)
+    marks = _names("mark", 200)
+    for i, name in enumerate(marks):
+        ff.markClass(name, (rnd.randint(0, 300), 500), ["@MARK_TOP", "@MARK_BOTTOM"][i%2])
+    ff.startFeature("mark")
+    ff.startLookup("base")
+    for name in _names("base", int(5000*scale)):
+        ff.startBaseMarks(name)
+        ff.anchorBasePosition((rnd.randint(0, 600), 700), "@MARK_TOP")
+        ff.anchorBasePosition((rnd.randint(0, 600), -200), "@MARK_BOTTOM")
+        ff.endMarks()
+    ff.endLookup()
+    ff.startLookup("ligature")
+    for name in _names("ligature", int(2000*scale)):
+        ff.startLigatureMarks(name)
+        for component in range(3):
+            if component:
+                ff.ligatureFlagComponent()
+            ff.anchorBasePosition((component*300+rnd.randint(0, 200), 700), "@MARK_TOP")
+            ff.anchorBasePosition((component*300+rnd.randint(0, 200), -200), "@MARK_BOTTOM")
+        ff.endMarks()
+    ff.endLookup()
+    ff.endFeature()
+
+def workloadMarkAttachments(scale):
+    """ The same kind of marks, from anchor columns with markAttachments(). """
+    rnd = random.Random(10)
+    glyphNames, anchorNames, xs, ys = [], [], [], []
+    def add(glyphName, anchorName, x, y):
+        glyphNames.append(glyphName)
+        anchorNames.append(anchorName)
+        xs.append(x)
+        ys.append(y)
+    for i, name in enumerate(_names("mark", 200)):
+        add(name, ["_top", "_bottom"][i%2], rnd.randint(0, 300), 500)
+    for name in _names("base", int(5000*scale)):
+        add(name, "top", rnd.randint(0, 600), 700)
+        add(name, "bottom", rnd.randint(0, 600), -200)
+    for name in _names("ligature", int(2000*scale)):
+        for component in range(1, 4):
+            add(name, "top_%d"%component, component*300+rnd.randint(0, 200), 700)
+            add(name, "bottom_%d"%component, component*300+rnd.randint(0, 200), -200)
+    return lambda ff: ff.markAttachments(glyphNames, anchorNames, xs, ys)
+
+def workloadNesting(scale):
+    """ Lots of features with lots of lookups, titles and comments. """
+    return lambda ff: _emitNesting(ff, scale)
+
+def _emitNesting(ff, scale):
+    for feature in range(max(1, int(200*scale))):
+        ff.title("feature %d"%feature)
+        ff.startFeature("f%03d"%feature)
+        ff.lookupFlag("IgnoreMarks")
+        for lookup in range(50):
+            ff.startLookup("f%03d_lookup%02d"%(feature, lookup))
+            ff.comment("lookup %d"%lookup)
+            for rule in range(10):
+                ff.addLine("sub", "a%d"%rule, "by", "b%d;"%rule)
+            ff.endLookup()
+        ff.endFeature()
+
+workloads = [
+    ("kern", workloadKern),
+    ("kernPairs", workloadKernPairs),
+    ("groups", workloadGroups),
+    ("marks", workloadMarks),
+    ("markAttachments", workloadMarkAttachments),
+    ("nesting", workloadNesting),
+    ]
+
+kernSpeedupGoal = 10.0
+
+def kernSpeedup(data):
+    """ How much faster kernArrays() is than kern() for each pair:
+        (emit time ratio, emit and dump time ratio, emit and save time ratio).
+        None without both workloads.
+    """
+    loop = data["results"].get("kern")
+    bulk = data["results"].get("kernPairs")
+    if loop is None or bulk is None or "error" in loop or "error" in bulk:
+        return None
+    emit = loop["emitTime"]/max(bulk["emitTime"], 1e-9)
+    withDump = (loop["emitTime"]+loop["dumpTime"])/max(bulk["emitTime"]+bulk["dumpTime"], 1e-9)
+    withSave = (loop["emitTime"]+loop["saveTime"])/max(bulk["emitTime"]+bulk["saveTime"], 1e-9)
+    return emit, withDump, withSave
+
+def _peakRSS():
+    """ Peak resident memory of this process in bytes. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak*1024
+
+def _run(workload, scale, formatterOptions, repeat, queue):
+    """ Run one workload, the best time of repeat runs. Runs in its own process. """
+    dirName = tempfile.mkdtemp()
+    try:
+        emit = workload(scale)
+        startRSS = _peakRSS()
+        emitTimes, dumpTimes, saveTimes = [], [], []
+        for i in range(max(1, repeat)):
+            # the formatter of the run before can go first
+            ff = None
+            ff = FeatureFormatter(dirName, featurePrefix="BENCH", **formatterOptions)
+            start = time.time()
+            emit(ff)
+            emitTimes.append(time.time()-start)
+            start = time.time()
+            text = ff.dump()
+            dumpTimes.append(time.time()-start)
+            size = len(text)
+            del text
+            start = time.time()
+            ff.save("bench")
+            saveTimes.append(time.time()-start)
+        emitTime, dumpTime, saveTime = min(emitTimes), min(dumpTimes), min(saveTimes)
+        queue.put(dict(
+            lines=ff.lineCount,
+            bytes=size,
+            emitTime=emitTime,
+            linesPerSecond=ff.lineCount/max(emitTime, 1e-9),
+            renderedLinesPerSecond=ff.lineCount/max(emitTime+dumpTime, 1e-9),
+            dumpTime=dumpTime,
+            saveTime=saveTime,
+            peakRSS=_peakRSS(),
+            peakRSSIncrease=_peakRSS()-startRSS,
+            ))
+    except:
+        queue.put(dict(error=traceback.format_exc(5)))
+    finally:
+        shutil.rmtree(dirName)
+
+def runBenchmarks(names=None, scale=1.0, repeat=3, **formatterOptions):
+    """ Run the workloads, all of them if names is None.
+        The times are the best of repeat runs.
+        Returns a dict that can be saved as json.
+    """
+    results = {}
+    for name, workload in workloads:
+        if names and name not in names:
+            continue
+        queue = Queue()
+        process = Process(target=_run, args=(workload, scale, formatterOptions, repeat, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+    return dict(
+        time=time.strftime("%Y-%m-%d %H:%M:%S"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        scale=scale,
+        repeat=repeat,
+        formatterOptions=formatterOptions,
+        results=results,
+        )
+
+def report(data, previous=None):
+    """ Print a table of the results, with the ratio to a previous run. """
+    columns = ["lines", "linesPerSecond", "renderedLinesPerSecond", "emitTime", "dumpTime", "saveTime", "peakRSSIncrease"]
+    titles = dict(linesPerSecond="emit lines/s", renderedLinesPerSecond="+dump lines/s")
+    print "%-16s"%"workload" + "".join(["%16s"%titles.get(column, column) for column in columns])
+    for name, workload in workloads:
+        result = data["results"].get(name)
+        if result is None:
+            continue
+        if "error" in result:
+            print "%-16s"%name, result["error"]
+            continue
+        print "%-16s"%name + "".join(["%16.3f"%result[column] for column in columns])
+        if previous is not None and "lines" in previous["results"].get(name, {}):
+            old = previous["results"][name]
+            ratios = []
+            for column in columns:
+                # older runs don't have all the columns
+                if old.get(column):
+                    ratios.append("%15.2fx"%(result[column]/float(old[column])))
+                else:
+                    ratios.append("%16s"%"-")
+            print "%-16s"%"  vs previous" + "".join(ratios)
+    speedup = kernSpeedup(data)
+    if speedup is not None:
+        print "kernArrays() vs kern(): %3.1fx to emit, %3.1fx with dump(), %3.1fx with save(), the goal is %3.1fx"%(speedup+(kernSpeedupGoal,))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the FeatureFormatter.")
+    parser.add_argument("workloads", nargs="*", help="workloads to run: %s"%", ".join([name for name, workload in workloads]))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the size of the workloads")
+    parser.add_argument("--repeat", type=int, default=3, help="run each workload this many times, the best times count")
+    parser.add_argument("--stream", action="store_true", help="use the streaming mode")
+    parser.add_argument("--output", help="save the results in this json file")
+    parser.add_argument("--compare", help="json file of a previous run to compare with")
+    parser.add_argument("--check", action="store_true", help="exit with an error when kernArrays() and save() are not kernSpeedupGoal times faster than kern() and save()")
+    args = parser.parse_args()
+    options = {}
+    if args.stream:
+        options["stream"] = True
+    data = runBenchmarks(args.workloads, args.scale, args.repeat, **options)
+    previous = None
+    if args.compare:
+        f = open(args.compare)
+        previous = json.load(f)
+        f.close()
+    report(data, previous)
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(data, f, indent=4, sort_keys=True)
+        f.close()
+    if args.check:
+        speedup = kernSpeedup(data)
+        if speedup is None or speedup[2] < kernSpeedupGoal:
+            sys.exit(1)
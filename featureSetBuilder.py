@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import time
+import inspect
+from multiprocessing import Pool
+
+from featureFormatter import FeatureFormatter, feaFileName
+from featureDependencies import IncludeGraph
+
+"""
+    Build a whole set of features at the same time.
+    Each feature gets its own FeatureFormatter in a separate process,
+    the results are saved by the processes, then a master file includes
+    them in the order the generators were given.
+    With incremental=True only the features that are outdated are made again,
+    see featureDependencies.py.
+    See the test() at the end for a demo.
+
+"""
+
+def _buildFeature(job):
+    """ Run one generator and save its feature file. Runs in the pool.
+        Returns the title, the path, True if the file was written,
+        and the includes and inputs of the formatter.
+    """
+    dirName, featurePrefix, title, generator, formatterOptions, skipUnchanged = job
+    ff = FeatureFormatter(dirName, featurePrefix=featurePrefix, **formatterOptions)
+    generator(ff)
+    if skipUnchanged:
+        path, written = ff.saveIfChanged(title)
+    else:
+        path = ff.save(title)
+        written = True
+    return title, path, written, ff.includes, ff.inputs
+
+def _generatorSource(generator):
+    """ The file a generator is defined in, a change there changes the feature. """
+    try:
+        return inspect.getsourcefile(generator)
+    except TypeError:
+        return None
+
+class FeatureSetBuilder(object):
+    """
+
+        FeatureSetBuilder object
+
+            dirName                 the dir to write the .fea files in
+            generators              list of (title, callable) in the order of the master file.
+                                    The callable gets a new FeatureFormatter and writes its feature in it.
+                                    The pool has to pickle them, so use module level functions.
+            featurePrefix="AT"      passed on to the FeatureFormatters
+            masterTitle="master"    the master file is "feature_<prefix>_<masterTitle>.fea"
+            processes=None          number of processes, None is one per core, 0 builds here, one after the other.
+            skipUnchanged=False     True saves with saveIfChanged(), files with the same content are left alone.
+            incremental=False       True keeps an IncludeGraph in the dir and only runs the generators
+                                    of the files that are outdated. Generators can add their inputs with
+                                    ff.addInput(), the file a generator is defined in is always an input.
+                                    The master file is only written when a feature was.
+            **formatterOptions      other arguments for the FeatureFormatters
+
+        All files get the same timestamp, so a serial and a parallel build write the same bytes.
+        After build(), results is a list of (title, absolute path, written) for each generator.
+
+    """
+    def __init__(self,
+            dirName,
+            generators,
+            featurePrefix="AT",
+            masterTitle="master",
+            processes=None,
+            skipUnchanged=False,
+            incremental=False,
+            **formatterOptions
+            ):
+        self.dirName = dirName
+        self.generators = list(generators)
+        self.featurePrefix = featurePrefix
+        self.masterTitle = masterTitle
+        self.processes = processes
+        self.skipUnchanged = skipUnchanged
+        self.incremental = incremental
+        self.formatterOptions = formatterOptions
+        self.results = []
+
+    def _path(self, title):
+        return os.path.abspath(os.path.join(self.dirName, feaFileName(self.featurePrefix, title)))
+
+    def build(self):
+        """ Build all the features and the master file. Return the path of the master file. """
+        options = dict(self.formatterOptions)
+        if options.get("timeStamp") is None:
+            options["timeStamp"] = time.time()
+        generators = self.generators
+        graph = None
+        if self.incremental:
+            graph = IncludeGraph(self.dirName)
+            masterPath = self._path(self.masterTitle)
+            outdated = set(graph.outdated([self._path(title) for title, generator in self.generators] + [masterPath]))
+            generators = [(title, generator) for title, generator in self.generators
+                    if self._path(title) in outdated]
+        jobs = [(self.dirName, self.featurePrefix, title, generator, options, self.skipUnchanged)
+                for title, generator in generators]
+        if self.processes == 0 or not jobs:
+            results = map(_buildFeature, jobs)
+        else:
+            pool = Pool(self.processes)
+            try:
+                # map keeps the order, chunksize 1 hands out the next feature to whoever is free.
+                results = pool.map(_buildFeature, jobs, 1)
+            finally:
+                pool.close()
+                pool.join()
+        built = {}
+        for (title, generator), (title, path, written, includes, inputs) in zip(generators, results):
+            built[title] = (title, os.path.abspath(path), written)
+            if graph is not None:
+                source = _generatorSource(generator)
+                if source is not None:
+                    inputs = inputs + [source]
+                graph.record(path, includes, inputs)
+        self.results = [built.get(title, (title, self._path(title), False))
+                for title, generator in self.generators]
+        if graph is not None:
+            # the master includes the files the graph just looked at
+            options["statCache"] = graph.statCache
+        master = FeatureFormatter(self.dirName, featurePrefix=self.featurePrefix, **options)
+        for title, path, written in self.results:
+            master.include(os.path.basename(path))
+        if graph is not None:
+            recorded = graph.files.get(masterPath)
+            if masterPath not in outdated and recorded is not None \
+                    and recorded["includes"] == [self._path(title) for title, generator in self.generators]:
+                graph.save()
+                return masterPath
+            master.includeGraph = graph
+            path = self._saveMaster(master)
+            graph.save()
+            return path
+        return self._saveMaster(master)
+
+    def _saveMaster(self, master):
+        if self.skipUnchanged:
+            path, written = master.saveIfChanged(self.masterTitle)
+            return path
+        return master.save(self.masterTitle)
+
+def _testKern(ff):
+    ff.startFeature("kern")
+    ff.kernPairs(dict((("name_%d"%i, "name_%d"%(i+1)), -i) for i in range(100)), sort=True)
+    ff.endFeature()
+
+def _testLiga(ff):
+    ff.startFeature("liga")
+    ff.addLine("sub", "f", "i", "by", "f_i;")
+    ff.endFeature()
+
+if __name__ == "__main__":
+    def test():
+        """
+            This shows how to build a couple of features at once.
+
+        """
+        builder = FeatureSetBuilder(
+            os.getcwd(),
+            [("kern", _testKern), ("liga", _testLiga)],
+            featurePrefix="TEST",
+            )
+        print "saved at", builder.build()
+        for title, path, written in builder.results:
+            print title, path, written
+
+    test()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import re
+import mmap
+import shutil
+import tempfile
+
+"""
+    Replace a single feature or lookup block in a .fea file
+    that was written by a FeatureFormatter, without generating
+    and writing the whole file again.
+
+    The file is indexed through a memory map, so only the pages the scan
+    touches are read. If the new block has the same length it is written
+    in place, otherwise the file is rewritten from the start of the block.
+    The "# file structure:" header is updated when the structure of a
+    feature changed, that needs a rewrite of the whole file.
+
+    The new block has to be written with the same indentation as the
+    old one, so use the same startIndent and indentSpace.
+
+"""
+
+_blockPattern = re.compile(
+    r"^[ \t]*(?:(feature|lookup)[ \t]+([^\s{]+)[ \t]*\{|\}[ \t]*([^\s;]+)[ \t]*;)",
+    re.MULTILINE)
+
+def indexBlocks(data):
+    """ Find the feature and lookup blocks in generated .fea text.
+        data can be a string or an mmap.
+        Returns a list of (kind, name, start, end) in the order the blocks start.
+        start is the offset of the first line, end the offset after the
+        closing "} name;", without the newline.
+    """
+    blocks = []
+    stack = []
+    for match in _blockPattern.finditer(data):
+        kind, name, closing = match.groups()
+        if kind is not None:
+            stack.append((kind, name, match.start(), len(blocks)))
+            blocks.append(None)
+        elif stack and stack[-1][1] == closing:
+            # tables close with their tag too, they are not on the stack
+            kind, name, start, index = stack.pop()
+            blocks[index] = (kind, name, start, match.end())
+    return [block for block in blocks if block is not None]
+
+def findBlock(blocks, name, kind="feature"):
+    for block in blocks:
+        if block[0] == kind and block[1] == name:
+            return block
+    return None
+
+def _headerEnd(data):
+    """ Offset after the structure lines that follow "# file structure:". """
+    if not data[:17] == "# file structure:":
+        return 0
+    offset = data.find("\n") + 1
+    while offset and data[offset:offset+2] == "# ":
+        offset = data.find("\n", offset) + 1
+    if offset == 0:
+        return len(data)
+    return offset
+
+def _structureRange(lines, name, kind):
+    """ Index of the first and after the last structure line of a block. """
+    if kind == "feature":
+        first = "feature %s {"%name
+        last = "} %s;"%name
+    else:
+        first = last = "lookup %s"%name
+    stripped = [line.lstrip("#").strip() for line in lines]
+    if first not in stripped:
+        return None
+    start = stripped.index(first)
+    for end in range(start, len(stripped)):
+        if stripped[end] == last:
+            return start, end+1
+    return None
+
+def spliceFeature(path, ff, name=None, kind="feature"):
+    """ Replace the block of feature (or lookup) name in the file at path
+        with the same block from FeatureFormatter ff.
+        name defaults to the last feature in ff.
+        Returns the number of bytes written.
+        The .md5 file saveIfChanged() keeps next to the .fea is removed,
+        the next saveIfChanged() writes the file again.
+    """
+    if name is None:
+        name = ff.featureNames[-1]
+    written = _splice(path, ff, name, kind)
+    hashPath = path + ".md5"
+    if os.path.exists(hashPath):
+        os.remove(hashPath)
+    ff.statCache.forget(path)
+    return written
+
+def _splice(path, ff, name, kind):
+    newText = ff.dump()
+    newBlock = findBlock(indexBlocks(newText), name, kind)
+    if newBlock is None:
+        raise KeyError("no %s %s in the formatter"%(kind, name))
+    blockText = newText[newBlock[2]:newBlock[3]]
+    newStructure = ["# %s%s"%(ff.indentSpace, line) for line in ff.structure]
+    f = open(path, "r+b")
+    try:
+        data = mmap.mmap(f.fileno(), 0)
+        try:
+            block = findBlock(indexBlocks(data), name, kind)
+            if block is None:
+                raise KeyError("no %s %s in %s"%(kind, name, path))
+            start, end = block[2], block[3]
+            headerEnd = _headerEnd(data)
+            header = data[:headerEnd].split("\n")
+            oldRange = _structureRange(header, name, kind)
+            newRange = _structureRange(newStructure, name, kind)
+            if oldRange is not None and newRange is not None:
+                newHeader = header[:oldRange[0]] + newStructure[newRange[0]:newRange[1]] + header[oldRange[1]:]
+                if newHeader != header:
+                    return _rewrite(path, data, "\n".join(newHeader), headerEnd, start, end, blockText)
+            if end-start == len(blockText):
+                data[start:end] = blockText
+                data.flush()
+                return len(blockText)
+            tail = data[end:]
+        finally:
+            data.close()
+        f.seek(start)
+        f.write(blockText)
+        f.write(tail)
+        f.truncate()
+        return len(blockText) + len(tail)
+    finally:
+        f.close()
+
+def _rewrite(path, data, header, headerEnd, start, end, blockText):
+    """ The header changed, write a new file and move it in place. """
+    handle, tempPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    f = os.fdopen(handle, "wb")
+    try:
+        f.write(header)
+        f.write(data[headerEnd:start])
+        f.write(blockText)
+        f.write(data[end:])
+    finally:
+        f.close()
+    shutil.copymode(path, tempPath)
+    os.rename(tempPath, path)
+    return os.path.getsize(path)
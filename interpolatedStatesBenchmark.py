@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import time
+import json
+import random
+import shutil
+import platform
+import tempfile
+
+from interpolatedStatesEngine import InterpolationEngine, FrameCache, SliderScheduler, StageTimer, \
+    StandInGlyph, readGlyph, writeGlyph, buildGlyph, fingerprint
+from interpolatedStatesHistory import HistoryFile, writeHistory
+
+"""
+    Benchmarks for the Interpolated States pipeline, with stand-in glyphs.
+    No RoboFont, vanilla or AppKit needed.
+
+    For a number of point counts and state counts it times each stage:
+
+        capture     read the glyph and make its fingerprint, for a new state
+        dedup       look for the same state
+        record      add the state to the engine
+        blend       one blend at a random slider value
+        frame       a slider value that is not in the frame cache yet
+        write       put a frame in the glyph
+        build       draw the glyph again, for a jump to another segment
+        latency     a slider value from the scheduler to the glyph, no cache
+        save        write the history file
+        load        open the history file and make a state
+
+    Each stage is reported as percentiles in milliseconds. A glyph is too heavy
+    to scrub when the p95 of the latency is more than the frame interval.
+
+        python interpolatedStatesBenchmark.py
+        python interpolatedStatesBenchmark.py --points 100 1000 --states 16
+        python interpolatedStatesBenchmark.py --output new.json --compare old.json
+
+"""
+
+frameInterval = 1/30.0
+
+def makeGlyph(points, rnd):
+    """ A stand-in glyph with this many points, in contours of 16 points: curves with
+        their off curve points. With 4 anchors and 2 components.
+    """
+    contours = []
+    for i in range(max(1, points//16)):
+        contour = []
+        for j in range(16):
+            pointType = ["curve", "offcurve", "offcurve", "curve"][j%4]
+            contour.append((rnd.randint(0, 1000), rnd.randint(-200, 800), pointType))
+        contours.append(contour)
+    anchors = [(name, rnd.randint(0, 500), 700) for name in ("top", "bottom", "left", "right")]
+    components = [("acute", (100, 0), (1, 1)), ("dotaccent", (300, 600), (0.8, 0.8))]
+    return StandInGlyph("bench", contours, anchors, components, 600)
+
+def editGlyph(glyph, rnd, fraction=0.1):
+    """ Move some of the points, like an edit between two states. """
+    points = [point for contour in glyph.contours for point in contour.points]
+    for point in rnd.sample(points, max(1, int(len(points)*fraction))):
+        point.x += rnd.randint(-20, 20)
+        point.y += rnd.randint(-20, 20)
+    glyph.width += rnd.randint(-5, 5)
+
+def runCase(points, states, repeat=200, seed=100):
+    """ Time the stages for one glyph size and number of states. Returns a StageTimer. """
+    rnd = random.Random(seed)
+    timer = StageTimer(size=max(repeat, states))
+    glyph = makeGlyph(points, rnd)
+    engine = InterpolationEngine(maxStates=max(256, states))
+    for i in range(states):
+        editGlyph(glyph, rnd)
+        with timer.time("capture"):
+            structure, coordinates = readGlyph(glyph)
+            glyphFingerprint = fingerprint(structure, coordinates)
+        with timer.time("dedup"):
+            engine.find(structure, coordinates, glyphFingerprint, last=True)
+        with timer.time("record"):
+            engine.addCoordinates(structure, coordinates, None, glyphFingerprint)
+    for i in range(repeat):
+        factor = rnd.random()
+        with timer.time("blend"):
+            engine.blend(factor)
+    frames = FrameCache(engine, steps=repeat)
+    frameList = []
+    for value in range(repeat):
+        with timer.time("frame"):
+            frameList.append(frames.frame(value))
+    for frame in frameList:
+        with timer.time("write"):
+            writeGlyph(glyph, frame)
+    for frame in frameList[:max(1, repeat//10)]:
+        with timer.time("build"):
+            buildGlyph(glyph, structure, frame)
+    # a drag without the cache, every value computed and applied on the main thread
+    mainLoop = []
+    scheduler = SliderScheduler(lambda value: engine.blend(value/float(repeat)).tolist(),
+        lambda frame: writeGlyph(glyph, frame),
+        lambda delay, function: mainLoop.append(function),
+        clock=time.time, background=False, timer=timer)
+    for value in range(repeat):
+        scheduler.request(value)
+        while mainLoop:
+            mainLoop.pop(0)()
+    dirName = tempfile.mkdtemp()
+    try:
+        path = os.path.join(dirName, "states.bin")
+        for i in range(max(1, repeat//20)):
+            with timer.time("save"):
+                writeHistory(path, [("bench", engine)])
+            with timer.time("load"):
+                history = HistoryFile(path)
+                history.engine("bench").row(states//2)
+            history.close()
+    finally:
+        shutil.rmtree(dirName)
+    return timer
+
+def runBenchmarks(pointCounts=(100, 1000, 5000, 20000), stateCounts=(4, 64, 256), repeat=200):
+    """ Run the cases. Returns a dict that can be saved as json. """
+    results = {}
+    for points in pointCounts:
+        for states in stateCounts:
+            timer = runCase(points, states, repeat)
+            results["%d points, %d states"%(points, states)] = dict(
+                points=points, states=states, stages=timer.asDict())
+    return dict(
+        time=time.strftime("%Y-%m-%d %H:%M:%S"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        repeat=repeat,
+        results=results,
+        )
+
+def _caseOrder(data):
+    return sorted(data["results"].items(), key=lambda item: (item[1]["points"], item[1]["states"]))
+
+def report(data, previous=None, percent="p95"):
+    """ Print a table of one percentile of each stage, with the ratio to a previous run.
+        Then the glyph sizes that are too heavy to scrub.
+    """
+    stages = ["capture", "dedup", "record", "blend", "frame", "write", "build", "latency", "save", "load"]
+    print "%s in ms"%percent
+    print "%-24s"%"case" + "".join(["%10s"%stage for stage in stages])
+    for name, result in _caseOrder(data):
+        values = result["stages"]
+        print "%-24s"%name + "".join(["%10.3f"%values[stage][percent] for stage in stages])
+        if previous is not None and name in previous["results"]:
+            old = previous["results"][name]["stages"]
+            ratios = []
+            for stage in stages:
+                if stage in old and old[stage][percent]:
+                    ratios.append("%9.2fx"%(values[stage][percent]/old[stage][percent]))
+                else:
+                    ratios.append("%10s"%"-")
+            print "%-24s"%"  vs previous" + "".join(ratios)
+    heavy = [name for name, result in _caseOrder(data)
+        if result["stages"]["latency"]["p95"] > 1000*frameInterval]
+    if heavy:
+        print "too heavy to scrub at %d frames a second:"%round(1/frameInterval), ", ".join(heavy)
+    else:
+        print "all cases scrub at %d frames a second"%round(1/frameInterval)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the Interpolated States pipeline.")
+    parser.add_argument("--points", type=int, nargs="+", default=[100, 1000, 5000, 20000], help="points in the glyph")
+    parser.add_argument("--states", type=int, nargs="+", default=[4, 64, 256], help="number of states")
+    parser.add_argument("--repeat", type=int, default=200, help="times each stage runs")
+    parser.add_argument("--percentile", default="p95", choices=["p50", "p95", "p99", "max"], help="the column to report")
+    parser.add_argument("--output", help="save the results in this json file")
+    parser.add_argument("--compare", help="json file of a previous run to compare with")
+    args = parser.parse_args()
+    data = runBenchmarks(args.points, args.states, args.repeat)
+    previous = None
+    if args.compare:
+        f = open(args.compare)
+        previous = json.load(f)
+        f.close()
+    report(data, previous, args.percentile)
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(data, f, indent=4, sort_keys=True)
+        f.close()
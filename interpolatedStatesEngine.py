@@ -0,0 +1,1195 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import sys
+import math
+import time
+import threading
+import numpy
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+"""
+    The interpolation behind the Interpolated States tool,
+    without the window, the observers or RoboFont.
+
+    A glyph is read as a list of coordinates: the points of the contours,
+    the anchors, the offset and scale of the components and the advance width.
+    The recorded states of a glyph are kept as the coordinates that changed
+    since the state before, with a full copy every couple of states, and there
+    is a limit to the number of states and the memory they use.
+    A slider position is a single blend of two states into a buffer that is
+    made once, then the coordinates are written back in the glyph. A FrameCache
+    keeps the frames of the slider positions that were used, scrubbing back
+    and forth doesn't blend again.
+    A StateStore keeps an engine for each glyph, so the history of a glyph
+    is still there after working on another one. A GlyphGroup records a
+    selection or a whole layer as one state, one blend does all the glyphs.
+    interpolatedStatesHistory.py keeps the states on disk between sessions.
+    A SliderScheduler makes sure a fast drag only draws the newest slider
+    value. A StageTimer keeps the times of the stages, to see when a glyph
+    is too heavy to scrub.
+
+    Anything with the RoboFab glyph attributes will do as a glyph:
+        glyph.contours          contours with contour.points, points with x, y and type
+        glyph.anchors           anchors with name, x and y
+        glyph.components        components with baseGlyph, offset and scale
+        glyph.width
+    See the StandInGlyph at the end, and the test() for a demo.
+
+"""
+
+def readGlyph(glyph):
+    """ Return the structure and the coordinates of the glyph.
+        Glyphs with the same structure can be interpolated: the same point types
+        in the same contours, the same anchor names and the same components.
+    """
+    coordinates = []
+    contours = []
+    for contour in glyph.contours:
+        types = []
+        for point in contour.points:
+            coordinates.append((point.x, point.y))
+            types.append(point.type)
+        contours.append(tuple(types))
+    anchors = []
+    for anchor in glyph.anchors:
+        coordinates.append((anchor.x, anchor.y))
+        anchors.append(anchor.name)
+    components = []
+    for component in glyph.components:
+        coordinates.append(component.offset)
+        coordinates.append(component.scale)
+        components.append(component.baseGlyph)
+    coordinates.append((glyph.width, 0))
+    structure = (tuple(contours), tuple(anchors), tuple(components))
+    return structure, numpy.array(coordinates, dtype=float)
+
+_fingerprintWeights = {}    # number of values: odd random 64 bit weights
+
+def fingerprint(structure, coordinates):
+    """ 64 bit hash of the coordinates: the bits of the floats as 64 bit integers,
+        times a random weight for each position, summed. One dot product over a view,
+        ten times faster than hashing the bytes.
+        Equal glyphs have equal fingerprints, the other way round needs a check.
+        The structure is left out, hashing it takes longer than the coordinates.
+        Compare the structure when the fingerprints are equal.
+        Adding 0.0 makes -0.0 a 0.0, they are the same coordinate with other bits.
+    """
+    values = numpy.ascontiguousarray(coordinates + 0.0).view(numpy.uint64).ravel()
+    weights = _fingerprintWeights.get(values.size)
+    if weights is None:
+        random = numpy.random.RandomState(values.size)
+        weights = numpy.frombuffer(random.bytes(8*values.size), dtype=numpy.uint64) | numpy.uint64(1)
+        _fingerprintWeights[values.size] = weights
+    return int(numpy.dot(values, weights))
+
+def rowCount(structure):
+    """ The number of coordinates of a glyph with this structure. """
+    contours, anchors, components = structure
+    return sum([len(types) for types in contours]) + len(anchors) + 2*len(components) + 1
+
+def writeGlyph(glyph, coordinates, structure=None):
+    """ Put the coordinates back in a glyph with the same structure.
+        coordinates is an array or a list of (x, y).
+        With a structure the glyph is drawn again with it, for a glyph
+        that has a different structure.
+    """
+    if hasattr(coordinates, "tolist"):
+        values = coordinates.tolist()
+    else:
+        values = coordinates
+    if structure is not None:
+        buildGlyph(glyph, structure, values)
+        return
+    i = 0
+    for contour in glyph.contours:
+        for point in contour.points:
+            point.x, point.y = values[i]
+            i += 1
+    for anchor in glyph.anchors:
+        anchor.x, anchor.y = values[i]
+        i += 1
+    for component in glyph.components:
+        component.offset = tuple(values[i])
+        component.scale = tuple(values[i+1])
+        i += 2
+    glyph.width = values[i][0]
+    if hasattr(glyph, "update"):
+        glyph.update()
+
+def buildGlyph(glyph, structure, coordinates):
+    """ Draw the glyph again, with the contours, anchors and components of the structure. """
+    glyph.clear()
+    contours, anchors, components = structure
+    pen = glyph.getPointPen()
+    i = 0
+    for types in contours:
+        pen.beginPath()
+        for pointType in types:
+            if pointType == "offcurve":
+                pointType = None
+            pen.addPoint(tuple(coordinates[i]), pointType)
+            i += 1
+        pen.endPath()
+    for name in anchors:
+        glyph.appendAnchor(name, tuple(coordinates[i]))
+        i += 1
+    for baseGlyph in components:
+        (x, y), (scaleX, scaleY) = coordinates[i], coordinates[i+1]
+        pen.addComponent(baseGlyph, (scaleX, 0, 0, scaleY, x, y))
+        i += 2
+    glyph.width = coordinates[i][0]
+    if hasattr(glyph, "update"):
+        glyph.update()
+
+class GlyphGroup(object):
+    """
+
+        GlyphGroup object
+
+            glyphs                  the glyphs, a selection or all the glyphs of a layer
+
+        A number of glyphs recorded as one state: the coordinates of all glyphs
+        in one array, one after the other, so one blend does all of them.
+        The structure has the glyph names, a state of other glyphs doesn't fit.
+        write() only writes the glyphs that are different from the last write,
+        in a drag most glyphs of a layer don't move. With a structure, the glyphs
+        that have a different structure than the last read or write are drawn again.
+
+    """
+    def __init__(self, glyphs):
+        self.glyphs = list(glyphs)
+        self.names = tuple([glyph.name for glyph in self.glyphs])
+        self.name = "%d glyphs"%len(self.glyphs)
+        self.offsets = None     # first row of each glyph, and the end
+        self.structure = None   # of the last read() or write()
+        self.written = 0        # glyphs written by the last write()
+        self._lastFrame = None
+
+    def __len__(self):
+        return len(self.glyphs)
+
+    def read(self):
+        """ Return the structure and the coordinates of all the glyphs. """
+        structures = []
+        arrays = []
+        offsets = [0]
+        for glyph in self.glyphs:
+            structure, coordinates = readGlyph(glyph)
+            structures.append(structure)
+            arrays.append(coordinates)
+            offsets.append(offsets[-1]+len(coordinates))
+        self.offsets = offsets
+        self._lastFrame = None
+        structure = (self.names, tuple(structures))
+        self.structure = structure
+        if not arrays:
+            return structure, numpy.empty((0, 2))
+        return structure, numpy.concatenate(arrays)
+
+    def write(self, coordinates, structure=None):
+        """ Put the coordinates back in the glyphs, an array or a list. Returns the number of glyphs written. """
+        if self.offsets is None:
+            raise ValueError("read() the glyphs first")
+        if hasattr(coordinates, "tolist"):
+            coordinates = coordinates.tolist()
+        build = ()
+        if structure is not None and structure is not self.structure and structure != self.structure:
+            old = self.structure[1]
+            build = set([i for i, glyphStructure in enumerate(structure[1]) if glyphStructure != old[i]])
+            offsets = [0]
+            for glyphStructure in structure[1]:
+                offsets.append(offsets[-1]+rowCount(glyphStructure))
+            self.offsets = offsets
+            self.structure = structure
+            self._lastFrame = None
+        last = self._lastFrame
+        offsets = self.offsets
+        written = 0
+        for i, glyph in enumerate(self.glyphs):
+            values = coordinates[offsets[i]:offsets[i+1]]
+            if i in build:
+                writeGlyph(glyph, values, structure[1][i])
+            elif last is not None and values == last[offsets[i]:offsets[i+1]]:
+                continue
+            else:
+                writeGlyph(glyph, values)
+            written += 1
+        self._lastFrame = coordinates
+        self.written = written
+        return written
+
+def _newStructure(structure, glyphStructure):
+    """ structure if the glyph has to be drawn again for it, None if writing the coordinates will do. """
+    if glyphStructure is None or structure is glyphStructure or structure == glyphStructure:
+        return None
+    return structure
+
+class InterpolationEngine(object):
+    """
+
+        InterpolationEngine object
+
+            keyframeInterval=16     a full copy of the coordinates every this many states,
+                                    the states in between only keep what changed.
+            maxStates=256           the most states to keep.
+            maxBytes=2**24          the most memory for the states.
+            eviction="thin"         what to drop when there are too many states.
+                                    "thin" drops every other state of the oldest half,
+                                    "ring" drops the oldest state.
+
+        A state with a different structure than the state before starts a new
+        segment. The states of a segment share their structure object, so which
+        neighbours can be blended is known when they are recorded. Between two
+        segments the slider doesn't blend, it jumps from one state to the next halfway.
+        version changes with every change to the states.
+        The end is an extra state for when only one state is recorded,
+        the slider then goes from that state to the end. An end with another
+        structure is like another segment, the slider jumps to it halfway.
+
+        A state is kept as the rows that changed since the state before it, with
+        their new values, or as a keyframe with all the rows. Making a state again
+        is a copy of the keyframe and a couple of assignments. The two rows
+        of the last blend are kept, scrubbing between two states doesn't make them again.
+
+    """
+    def __init__(self, keyframeInterval=16, maxStates=256, maxBytes=2**24, eviction="thin"):
+        self.keyframeInterval = keyframeInterval
+        self.maxStates = maxStates
+        self.maxBytes = maxBytes
+        self.eviction = eviction
+        self.structure = None   # of the last state
+        self.version = 0
+        self.info = []          # something to keep with each state, the tool keeps a GlyphState
+        self.fingerprints = []  # fingerprint of each state
+        self.structures = []    # structure of each state
+        self._fingerprintIndexes = {}   # fingerprint: numbers of the states with it, oldest first
+        self._firstNumber = 0   # number of the first state, index + _firstNumber is the number
+        self._entries = []      # (None, all rows) for a keyframe, (row indexes, rows) for a change
+        self._bytes = 0
+        self._sinceKeyframe = 0
+        self._last = None       # all rows of the last state
+        self._buffers = {}      # shape: the array for blend()
+        self._rows = [[None, None], [None, None]]   # [index, rows] of the last states that were made, newest last
+        self._end = None
+        self._endStructure = None
+        self._segmentVersion = None
+        self._compatible = []   # True for two neighbours that can be blended
+        self._endFits = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def memory(self):
+        """ Bytes used by the states in memory. States that are mapped from a file don't count. """
+        return self._bytes
+
+    def entries(self):
+        """ The states as they are kept: (None, all rows) for a keyframe,
+            (changed row indexes, their rows) for the others.
+        """
+        return list(self._entries)
+
+    def loadEntries(self, structures, entries, info, fingerprints):
+        """ Take states as entries() returns them, with the structure of each state,
+            from a history file for instance.
+            The arrays can be read only, a view of a memory map. They are only read
+            when a state is made, and only the entries from its keyframe.
+        """
+        self.clear()
+        if not entries:
+            return
+        if entries[0][0] is not None:
+            raise ValueError("the first state has to be a keyframe")
+        self.structures = []
+        for structure in structures:
+            if self.structures and structure == self.structures[-1]:
+                structure = self.structures[-1]
+            self.structures.append(structure)
+        self.structure = self.structures[-1]
+        self._entries = list(entries)
+        self.info = list(info)
+        self.fingerprints = list(fingerprints)
+        self._indexFingerprints()
+        self._bytes = sum([self._entryBytes(entry) for entry in self._entries])
+        self._sinceKeyframe = 0
+        for changedRows, rows in reversed(self._entries):
+            if changedRows is None:
+                break
+            self._sinceKeyframe += 1
+        self._last = self.row(-1)
+        self.version += 1
+
+    def addState(self, glyph, info=None):
+        """ Record the glyph as the next state. """
+        structure, coordinates = readGlyph(glyph)
+        return self.addCoordinates(structure, coordinates, info)
+
+    def find(self, structure, coordinates, glyphFingerprint=None, last=False):
+        """ Index of a state with exactly these coordinates, None if there is none.
+            last=True only looks at the last state. The states with the fingerprint are
+            looked up, their structure and coordinates are only compared when it is equal.
+        """
+        if glyphFingerprint is None:
+            glyphFingerprint = fingerprint(structure, coordinates)
+        numbers = self._fingerprintIndexes.get(glyphFingerprint)
+        if not numbers:
+            return None
+        count = len(self._entries)
+        if last:
+            candidates = numbers[-1:]
+        else:
+            candidates = reversed(numbers)
+        for number in candidates:
+            index = number - self._firstNumber
+            if last and index != count-1:
+                return None
+            stateStructure = self.structures[index]
+            if stateStructure is not structure and stateStructure != structure:
+                continue
+            if index == count-1:
+                row = self._last
+            else:
+                row = self.row(index)
+            if numpy.array_equal(row, coordinates):
+                return index
+        return None
+
+    def _indexFingerprints(self):
+        """ Number the states from 0 and index them by fingerprint again. """
+        self._firstNumber = 0
+        self._fingerprintIndexes = {}
+        for number, glyphFingerprint in enumerate(self.fingerprints):
+            self._fingerprintIndexes.setdefault(glyphFingerprint, []).append(number)
+
+    def _dropFirstFingerprint(self, glyphFingerprint):
+        """ Take the first state out of the fingerprint index. """
+        numbers = self._fingerprintIndexes[glyphFingerprint]
+        del numbers[0]
+        if not numbers:
+            del self._fingerprintIndexes[glyphFingerprint]
+
+    def addCoordinates(self, structure, coordinates, info=None, glyphFingerprint=None):
+        """ Record the coordinates as the next state. A different structure
+            than the last state starts a new segment. Returns True.
+        """
+        newSegment = not self._entries or structure != self.structure
+        if newSegment:
+            self.structure = structure
+            if self._last is None or self._last.shape != coordinates.shape:
+                self._last = numpy.empty(coordinates.shape)
+        else:
+            # the states of a segment share the structure
+            structure = self.structure
+            changed = numpy.flatnonzero((coordinates != self._last).any(axis=1)).astype(numpy.int32)
+        if newSegment or self._sinceKeyframe+1 >= self.keyframeInterval \
+                or changed.nbytes + changed.size*16 > coordinates.nbytes/2:
+            entry = (None, coordinates.copy())
+            self._sinceKeyframe = 0
+        else:
+            entry = (changed, coordinates[changed])
+            self._sinceKeyframe += 1
+        self._entries.append(entry)
+        self.info.append(info)
+        self.structures.append(structure)
+        if glyphFingerprint is None:
+            glyphFingerprint = fingerprint(structure, coordinates)
+        self.fingerprints.append(glyphFingerprint)
+        self._fingerprintIndexes.setdefault(glyphFingerprint, []).append(self._firstNumber + len(self._entries)-1)
+        self._bytes += self._entryBytes(entry)
+        numpy.copyto(self._last, coordinates)
+        self.version += 1
+        while len(self._entries) > 2 and (len(self._entries) > self.maxStates or self._bytes > self.maxBytes):
+            self._evict()
+        return True
+
+    def _entryBytes(self, entry):
+        indexes, rows = entry
+        if not rows.flags.owndata:
+            # a view of a file
+            return 0
+        if indexes is None:
+            return rows.nbytes
+        return indexes.nbytes + rows.nbytes
+
+    def _evict(self):
+        count = len(self._entries)
+        if self.eviction == "thin" and count > 4:
+            self._remove(range(1, count//2, 2))
+            return
+        # the oldest goes, the next one becomes a keyframe
+        second = self.row(1)
+        self._bytes -= self._entryBytes(self._entries[0]) + self._entryBytes(self._entries[1])
+        self._entries[1] = (None, second)
+        self._bytes += second.nbytes
+        del self._entries[0]
+        del self.info[0]
+        del self.structures[0]
+        self._dropFirstFingerprint(self.fingerprints.pop(0))
+        self._firstNumber += 1
+        self._forgetRows()
+
+    def _remove(self, indexes):
+        """ Drop the states at indexes and encode the others again. """
+        drop = set(indexes)
+        entries = []
+        info = []
+        fingerprints = []
+        structures = []
+        running = None
+        previous = None
+        sinceKeyframe = 0
+        for i, (changedRows, rows) in enumerate(self._entries):
+            if changedRows is None:
+                if running is None or running.shape != rows.shape:
+                    running = numpy.empty(rows.shape)
+                numpy.copyto(running, rows)
+            else:
+                running[changedRows] = rows
+            if i in drop:
+                continue
+            structure = self.structures[i]
+            if structures and structure == structures[-1]:
+                # a dropped state can join two segments
+                structure = structures[-1]
+            if previous is None or structure is not structures[-1] or sinceKeyframe+1 >= self.keyframeInterval:
+                entries.append((None, running.copy()))
+                sinceKeyframe = 0
+                previous = running.copy()
+                info.append(self.info[i])
+                fingerprints.append(self.fingerprints[i])
+                structures.append(structure)
+                continue
+            changed = numpy.flatnonzero((running != previous).any(axis=1)).astype(numpy.int32)
+            if changed.nbytes + changed.size*16 > running.nbytes/2:
+                entries.append((None, running.copy()))
+                sinceKeyframe = 0
+            else:
+                entries.append((changed, running[changed]))
+                sinceKeyframe += 1
+            numpy.copyto(previous, running)
+            info.append(self.info[i])
+            fingerprints.append(self.fingerprints[i])
+            structures.append(structure)
+        self._entries = entries
+        self.info = info
+        self.fingerprints = fingerprints
+        self.structures = structures
+        # the next state compares with the structure its segment has now
+        self.structure = structures[-1]
+        self._indexFingerprints()
+        self._sinceKeyframe = sinceKeyframe
+        self._bytes = sum([self._entryBytes(entry) for entry in entries])
+        self._forgetRows()
+
+    def _forgetRows(self):
+        for item in self._rows:
+            item[0] = None
+
+    def row(self, index, out=None):
+        """ The coordinates of the state at index, in out or in a new array. """
+        if index < 0:
+            index += len(self._entries)
+        start = self._keyframe(index)
+        if out is None:
+            out = numpy.empty(self._entries[start][1].shape)
+        numpy.copyto(out, self._entries[start][1])
+        for changedRows, rows in self._entries[start+1:index+1]:
+            out[changedRows] = rows
+        return out
+
+    def _keyframe(self, index):
+        """ Index of the keyframe a state is made from. """
+        while self._entries[index][0] is not None:
+            index -= 1
+        return index
+
+    def _cachedRow(self, index):
+        """ The state at index, from the two that were made last if it is one of them. """
+        for item in self._rows:
+            if item[0] == index:
+                self._rows.remove(item)
+                self._rows.append(item)
+                return item[1]
+        item = self._rows.pop(0)
+        if item[1] is not None and item[1].shape == self._entries[self._keyframe(index)][1].shape:
+            self.row(index, item[1])
+        else:
+            item[1] = self.row(index)
+        item[0] = index
+        self._rows.append(item)
+        return item[1]
+
+    def clear(self):
+        """ Forget the states. """
+        self._entries = []
+        self.info = []
+        self.fingerprints = []
+        self.structures = []
+        self._fingerprintIndexes = {}
+        self._firstNumber = 0
+        self._bytes = 0
+        self._forgetRows()
+        self.version += 1
+
+    def setEnd(self, glyph):
+        """ The state the slider goes to when there is only one recorded state. None for no end. """
+        if glyph is None:
+            self.setEndCoordinates(None, None)
+        else:
+            self.setEndCoordinates(*readGlyph(glyph))
+
+    def setEndCoordinates(self, structure, coordinates):
+        """ setEnd() with the structure and coordinates, of a GlyphGroup for instance. """
+        self._endStructure = structure
+        self._end = coordinates
+        self.version += 1
+
+    def segments(self):
+        """ (first, last) index of the states in each segment. """
+        segments = []
+        for index, structure in enumerate(self.structures):
+            if segments and structure is self.structures[index-1]:
+                segments[-1][1] = index
+            else:
+                segments.append([index, index])
+        return [tuple(segment) for segment in segments]
+
+    def _segments(self):
+        """ Which neighbours can be blended, worked out once for each version. """
+        if self._segmentVersion != self.version:
+            structures = self.structures
+            self._compatible = [structures[i] is structures[i+1] for i in range(len(structures)-1)]
+            self._endFits = self._end is not None and self._endStructure == self.structure
+            self._segmentVersion = self.version
+        return self._compatible, self._endFits
+
+    def _place(self, factor):
+        """ The state before factor, and how far to the next one.
+            With one state, index 1 is the end.
+        """
+        count = len(self._entries)
+        compatible, endFits = self._segments()
+        if count == 1:
+            if endFits:
+                return 0, factor
+            if self._end is not None and factor >= 0.5:
+                # another structure, no blend: jump halfway
+                return 1, 0
+            return 0, 0
+        length = count-1
+        if factor <= 0:
+            return 0, 0
+        if factor >= 1:
+            return length, 0
+        index = min(int(math.floor(length*factor)), length-1)
+        t = length*factor - index
+        if not compatible[index]:
+            # another structure, no blend: jump halfway
+            if t < 0.5:
+                return index, 0
+            return index+1, 0
+        return index, t
+
+    def structureAt(self, factor):
+        """ The structure of the blend at factor, None without states. """
+        if not self._entries:
+            return None
+        index = self._place(factor)[0]
+        if index == len(self._entries):
+            return self._endStructure
+        return self.structures[index]
+
+    def blend(self, factor, out=None):
+        """ The coordinates at slider factor 0 to 1, going through the states in order.
+            Written in out, or in a buffer of the engine. Returns None without states.
+            Between two segments there is no blend, structureAt() tells which one it is.
+
+            o--------o--------o--------o--------o    states
+            0        f                          1    factor
+        """
+        count = len(self._entries)
+        if not count:
+            return None
+        index, t = self._place(factor)
+        if index == count:
+            a = self._end
+        elif count > 1 and index == count-1:
+            a = self._last
+        else:
+            a = self._cachedRow(index)
+        if out is None:
+            out = self._buffers.get(a.shape)
+            if out is None:
+                out = self._buffers[a.shape] = numpy.empty(a.shape)
+        if t == 0:
+            numpy.copyto(out, a)
+            return out
+        if count == 1:
+            b = self._end
+        else:
+            b = self._cachedRow(index+1)
+        numpy.subtract(b, a, out)
+        out *= t
+        out += a
+        return out
+
+    def apply(self, glyph, factor, glyphStructure=None):
+        """ Write the blend at factor in the glyph. Returns False if there was nothing to write.
+            glyphStructure is the structure of the glyph now, if it is not the
+            structure of the blend the glyph is drawn again.
+        """
+        coordinates = self.blend(factor)
+        if coordinates is None:
+            return False
+        writeGlyph(glyph, coordinates, _newStructure(self.structureAt(factor), glyphStructure))
+        return True
+
+class FrameCache(object):
+    """
+
+        FrameCache object
+
+            engine                  the InterpolationEngine
+            steps=100               slider values go from 0 to steps
+            maxBytes=2**25          memory for the frames, the least recently used go first
+
+        Frames are kept by slider value and the version of the engine, so when the
+        states change the old frames are gone. A frame is kept as a list, ready to
+        be written in a glyph.
+
+    """
+    def __init__(self, engine, steps=100, maxBytes=2**25):
+        self.engine = engine
+        self.steps = steps
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()    # slider value: (frame, bytes)
+        self._version = None
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def clear(self):
+        self._frames.clear()
+        self._bytes = 0
+
+    def frame(self, value):
+        """ The coordinates at slider value as a list, None without states. """
+        value = int(round(value))
+        if self._version != self.engine.version:
+            self.clear()
+            self._version = self.engine.version
+        item = self._frames.pop(value, None)
+        if item is not None:
+            self.hits += 1
+            self._frames[value] = item
+            return item[0]
+        self.misses += 1
+        coordinates = self.engine.blend(value/float(self.steps))
+        if coordinates is None:
+            return None
+        frame = coordinates.tolist()
+        size = sys.getsizeof(frame) + len(frame)*(sys.getsizeof(frame[0]) + 2*sys.getsizeof(0.0))
+        while self._frames and self._bytes + size > self.maxBytes:
+            oldFrame, oldSize = self._frames.popitem(last=False)[1]
+            self._bytes -= oldSize
+        if size <= self.maxBytes:
+            self._frames[value] = (frame, size)
+            self._bytes += size
+        return frame
+
+    def structure(self, value):
+        """ The structure of the frame at slider value. """
+        return self.engine.structureAt(int(round(value))/float(self.steps))
+
+    def apply(self, glyph, value, glyphStructure=None):
+        """ Write the frame of slider value in the glyph. Returns False if there was nothing to write.
+            glyphStructure is the structure of the glyph now, as in InterpolationEngine.apply().
+        """
+        frame = self.frame(value)
+        if frame is None:
+            return False
+        writeGlyph(glyph, frame, _newStructure(self.structure(value), glyphStructure))
+        return True
+
+class StateStore(object):
+    """
+
+        StateStore object
+
+            maxGlyphs=64            the most glyphs to keep the states of
+            maxBytes=2**26          the most memory for all the states
+            load=None               load(key, **engineOptions) returns the engine for a key that is
+                                    not in the store, made with engineOptions from a history file, or None.
+            evicted=None            evicted(key, engine) is called for each engine that
+                                    trim() drops, to write its states somewhere.
+            **engineOptions         arguments for the InterpolationEngines
+
+        An InterpolationEngine for each key, a glyph name or anything else.
+        The glyphs that were not used for the longest time go first,
+        never the one that was asked for last.
+
+    """
+    def __init__(self, maxGlyphs=64, maxBytes=2**26, load=None, evicted=None, **engineOptions):
+        self.maxGlyphs = maxGlyphs
+        self.maxBytes = maxBytes
+        self.load = load
+        self.evicted = evicted
+        self.engineOptions = engineOptions
+        self._engines = OrderedDict()   # key: engine, the last used last
+
+    def __len__(self):
+        return len(self._engines)
+
+    def __contains__(self, key):
+        return key in self._engines
+
+    def keys(self):
+        return self._engines.keys()
+
+    def engines(self):
+        return self._engines.values()
+
+    def engine(self, key, create=True):
+        """ The engine for key, a new one if there is none yet.
+            With create=False it is None if there is none, so looking at
+            a glyph doesn't push out the glyphs that have states.
+        """
+        engine = self._engines.pop(key, None)
+        if engine is None and self.load is not None:
+            engine = self.load(key, **self.engineOptions)
+        if engine is None:
+            if not create:
+                return None
+            engine = InterpolationEngine(**self.engineOptions)
+        self._engines[key] = engine
+        self.trim()
+        return engine
+
+    def get(self, key):
+        """ The engine for key, None if there is none. Doesn't count as a use. """
+        return self._engines.get(key)
+
+    def discard(self, key):
+        self._engines.pop(key, None)
+
+    def memory(self):
+        return sum([engine.memory() for engine in self._engines.values()])
+
+    def trim(self):
+        """ Drop the least recently used glyphs until the store fits. """
+        if len(self._engines) < 2:
+            return
+        memory = self.memory()
+        while len(self._engines) > 1 and (len(self._engines) > self.maxGlyphs or memory > self.maxBytes):
+            key, engine = self._engines.popitem(last=False)
+            memory -= engine.memory()
+            if self.evicted is not None:
+                self.evicted(key, engine)
+
+class SliderScheduler(object):
+    """
+
+        SliderScheduler object
+
+            compute                 compute(value) returns the frame for a slider value
+            apply                   apply(frame) puts it in the glyph, on the main thread
+            callLater               callLater(delay, function) calls function on the main thread
+                                    after delay seconds. It is called from the worker thread too.
+            interval=1/30.0         seconds between two frames, at most
+            clock=time.time         the time in seconds
+            background=True         compute in a worker thread. False computes on the main
+                                    thread, just before the frame is applied.
+            timer=None              a StageTimer for the compute and apply times, and the
+                                    latency from request() to the frame in the glyph.
+
+        A drag sends lots of values, only the last one counts. request() keeps
+        the value, the worker computes the frame of the newest value, and the
+        main thread applies the newest frame, no more often than interval.
+        finish() is for the mouse up: it forgets what is still waiting and
+        computes and applies the final value right away.
+
+    """
+    def __init__(self, compute, apply, callLater, interval=1/30.0, clock=time.time, background=True, timer=None):
+        self.compute = compute
+        self.apply = apply
+        self.callLater = callLater
+        self.interval = interval
+        self.clock = clock
+        self.background = background
+        self.timer = timer
+        self.requested = 0      # values that came in
+        self.computed = 0       # frames that were made
+        self.applied = 0        # frames that were applied
+        self._condition = threading.Condition()
+        self._pending = None    # the newest value that has no frame yet
+        self._pendingTime = None
+        self._ready = None      # the newest frame that was not applied
+        self._readyTime = None  # when the value of that frame was requested
+        self._busy = False      # the worker is computing
+        self._generation = 0    # goes up with cancel(), older frames are dropped
+        self._scheduled = False
+        self._lastApplied = None
+        self._thread = None
+        self._stopped = False
+
+    def request(self, value):
+        """ A new slider value. Call from the main thread. """
+        self.requested += 1
+        with self._condition:
+            self._pending = value
+            self._pendingTime = self.clock()
+            if self.background:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._work)
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._condition.notify_all()
+                return
+        self._schedule()
+
+    def _work(self):
+        """ The worker thread: make the frame of the newest value. """
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                value = self._pending
+                requestTime = self._pendingTime
+                self._pending = None
+                self._busy = True
+                generation = self._generation
+            try:
+                frame = self._compute(value)
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+            with self._condition:
+                if generation != self._generation:
+                    continue
+                self.computed += 1
+                self._ready = frame
+                self._readyTime = requestTime
+            self._schedule()
+
+    def _schedule(self):
+        """ Ask the main thread to apply, when the interval since the last frame is over. """
+        with self._condition:
+            if self._scheduled:
+                return
+            self._scheduled = True
+            delay = 0
+            if self._lastApplied is not None:
+                delay = max(0, self._lastApplied + self.interval - self.clock())
+        self.callLater(delay, self._tick)
+
+    def _compute(self, value):
+        if self.timer is None:
+            return self.compute(value)
+        with self.timer.time("compute"):
+            return self.compute(value)
+
+    def _apply(self, frame, requestTime):
+        if self.timer is None:
+            self.apply(frame)
+        else:
+            with self.timer.time("apply"):
+                self.apply(frame)
+        self.applied += 1
+        self._lastApplied = self.clock()
+        if self.timer is not None and requestTime is not None:
+            self.timer.add("latency", self._lastApplied-requestTime)
+
+    def _tick(self):
+        """ On the main thread: apply the newest frame. """
+        with self._condition:
+            self._scheduled = False
+            frame = self._ready
+            requestTime = self._readyTime
+            self._ready = None
+            value = None
+            if not self.background:
+                value = self._pending
+                requestTime = self._pendingTime
+                self._pending = None
+        if value is not None:
+            frame = self._compute(value)
+            self.computed += 1
+        if frame is None:
+            return
+        self._apply(frame, requestTime)
+
+    def cancel(self):
+        """ Forget the values and frames that are waiting, and wait for the worker
+            to finish what it is doing. Call this before the states change.
+        """
+        with self._condition:
+            self._generation += 1
+            self._pending = None
+            self._ready = None
+            while self._busy:
+                self._condition.wait()
+
+    def finish(self, value):
+        """ The mouse went up: apply the frame of this value now. """
+        requestTime = self.clock()
+        self.cancel()
+        frame = self._compute(value)
+        self.computed += 1
+        if frame is not None:
+            self._apply(frame, requestTime)
+        else:
+            self._lastApplied = self.clock()
+
+    def stop(self):
+        """ Stop the worker thread. """
+        self.cancel()
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+class StageTimer(object):
+    """
+
+        StageTimer object
+
+            size=1000               the last this many times of each stage are kept
+            clock=time.time         the time in seconds
+            enabled=True            a timer that is not enabled keeps nothing
+
+        The times of each stage, capture or tick for instance, in seconds.
+        Times can be added from more than one thread.
+
+            with timer.time("capture"):
+                ...
+            print timer.report()
+
+    """
+    def __init__(self, size=1000, clock=time.time, enabled=True):
+        self.size = size
+        self.clock = clock
+        self.enabled = enabled
+        self._times = OrderedDict()     # stage: deque of seconds
+        self._lock = threading.Lock()   # around the changes and the copies of _times
+
+    def __contains__(self, stage):
+        return stage in self._times
+
+    def stages(self):
+        with self._lock:
+            return self._times.keys()
+
+    def add(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            times = self._times.get(stage)
+            if times is None:
+                times = self._times[stage] = deque(maxlen=self.size)
+            times.append(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """ Time the block as stage. """
+        if not self.enabled:
+            yield
+            return
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(stage, self.clock()-start)
+
+    def clear(self):
+        with self._lock:
+            self._times.clear()
+
+    def _copy(self, stage):
+        with self._lock:
+            return list(self._times.get(stage, ()))
+
+    def percentiles(self, stage, percents=(50, 95, 99)):
+        """ The times of stage at these percentiles, in seconds. None without times. """
+        times = self._copy(stage)
+        if not times:
+            return None
+        return [float(value) for value in numpy.percentile(times, percents)]
+
+    def asDict(self, percents=(50, 95, 99)):
+        """ For each stage the count and the percentiles, in milliseconds. """
+        with self._lock:
+            copies = [(stage, list(times)) for stage, times in self._times.items()]
+        data = OrderedDict()
+        for stage, times in copies:
+            if not times:
+                continue
+            item = dict(count=len(times), max=1000*max(times))
+            for percent, value in zip(percents, numpy.percentile(times, percents)):
+                item["p%d"%percent] = 1000*float(value)
+            data[stage] = item
+        return data
+
+    def report(self, percents=(50, 95, 99)):
+        """ A table of the percentiles in milliseconds. """
+        columns = ["p%d"%percent for percent in percents] + ["max"]
+        lines = ["%-12s%8s"%("stage", "count") + "".join(["%10s"%column for column in columns])]
+        for stage, item in self.asDict(percents).items():
+            lines.append("%-12s%8d"%(stage, item["count"]) + "".join(["%10.3f"%item[column] for column in columns]))
+        return "\n".join(lines)
+
+class _StandInPoint(object):
+    def __init__(self, x, y, type="line"):
+        self.x = x
+        self.y = y
+        self.type = type
+
+class _StandInContour(object):
+    def __init__(self, points):
+        self.points = points
+
+class _StandInAnchor(object):
+    def __init__(self, name, x, y):
+        self.name = name
+        self.x = x
+        self.y = y
+
+class _StandInComponent(object):
+    def __init__(self, baseGlyph, offset=(0, 0), scale=(1, 1)):
+        self.baseGlyph = baseGlyph
+        self.offset = offset
+        self.scale = scale
+
+class _StandInPointPen(object):
+    def __init__(self, glyph):
+        self.glyph = glyph
+
+    def beginPath(self):
+        self.glyph.contours.append(_StandInContour([]))
+
+    def addPoint(self, pt, segmentType=None, smooth=False, name=None, **kwargs):
+        self.glyph.contours[-1].points.append(_StandInPoint(pt[0], pt[1], segmentType or "offcurve"))
+
+    def endPath(self):
+        pass
+
+    def addComponent(self, baseGlyph, transformation):
+        scaleX, xy, yx, scaleY, x, y = transformation
+        self.glyph.components.append(_StandInComponent(baseGlyph, (x, y), (scaleX, scaleY)))
+
+class StandInGlyph(object):
+    """ Just enough of a glyph for the engine, to use it without a font editor.
+        contours is a list of lists of (x, y) or (x, y, type),
+        anchors a list of (name, x, y), components a list of (baseGlyph, offset, scale).
+    """
+    def __init__(self, name="glyph", contours=(), anchors=(), components=(), width=500):
+        self.name = name
+        self.contours = [_StandInContour([_StandInPoint(*point) for point in contour]) for contour in contours]
+        self.anchors = [_StandInAnchor(*anchor) for anchor in anchors]
+        self.components = [_StandInComponent(*component) for component in components]
+        self.width = width
+
+    def clear(self):
+        self.contours = []
+        self.anchors = []
+        self.components = []
+
+    def getPointPen(self):
+        return _StandInPointPen(self)
+
+    def appendAnchor(self, name, position):
+        self.anchors.append(_StandInAnchor(name, position[0], position[1]))
+
+    def copy(self):
+        return StandInGlyph(self.name,
+            [[(point.x, point.y, point.type) for point in contour.points] for contour in self.contours],
+            [(anchor.name, anchor.x, anchor.y) for anchor in self.anchors],
+            [(component.baseGlyph, component.offset, component.scale) for component in self.components],
+            self.width)
+
+if __name__ == "__main__":
+    def test():
+        """
+            This shows how to use the engine without RoboFont.
+
+        """
+        glyph = StandInGlyph("a",
+            contours=[[(0, 0), (100, 0), (100, 100), (0, 100)]],
+            anchors=[("top", 50, 120)],
+            components=[("acute", (10, 0), (1, 1))],
+            width=200)
+        engine = InterpolationEngine()
+        engine.addState(glyph)
+        glyph.contours[0].points[2].x = 300
+        glyph.anchors[0].y = 200
+        glyph.width = 400
+        engine.addState(glyph)
+        for factor in (0, 0.25, 0.5, 1):
+            engine.apply(glyph, factor)
+            print factor, glyph.contours[0].points[2].x, glyph.anchors[0].y, glyph.width
+        frames = FrameCache(engine)
+        for value in (0, 50, 100, 50, 0):
+            frames.apply(glyph, value)
+        print "frames: %d hits, %d misses"%(frames.hits, frames.misses)
+
+        # a fake clock and a list as the main loop
+        now = [0.0]
+        mainLoop = []
+        def callLater(delay, function):
+            mainLoop.append(function)
+        scheduler = SliderScheduler(frames.frame, lambda frame: writeGlyph(glyph, frame),
+            callLater, clock=lambda: now[0], background=False)
+        for value in range(0, 60, 5):
+            scheduler.request(value)
+        while mainLoop:
+            mainLoop.pop(0)()
+        print "drag to 55:", glyph.contours[0].points[2].x
+        now[0] += 0.01
+        scheduler.finish(100)
+        print "mouse up at 100:", glyph.contours[0].points[2].x
+        print "scheduler: %d requested, %d applied"%(scheduler.requested, scheduler.applied)
+
+        # 300 glyphs as one state, 30 of them change
+        glyphs = [StandInGlyph("g%d"%i, contours=[[(0, 0), (100, 0), (100, 100), (0, 100)]]*3)
+            for i in range(300)]
+        group = GlyphGroup(glyphs)
+        groupEngine = InterpolationEngine()
+        groupEngine.addCoordinates(*group.read())
+        for groupGlyph in glyphs[::10]:
+            groupGlyph.width += 100
+        groupEngine.addCoordinates(*group.read())
+        groupFrames = FrameCache(groupEngine)
+        start = time.time()
+        for value in range(101):
+            group.write(groupFrames.frame(value))
+        print "300 glyphs, 101 frames: %3.3f sec, %d glyphs written per frame"%(time.time()-start, group.written)
+
+        # a state with a point less starts a new segment, the slider jumps to it
+        other = glyph.copy()
+        other.contours[0].points.pop()
+        engine.addState(other)
+        print "segments:", engine.segments()
+        structure = readGlyph(glyph)[0]
+        for factor in (0, 0.25, 0.6, 0.8, 0.6):
+            engine.apply(glyph, factor, structure)
+            structure = engine.structureAt(factor)
+            print factor, len(glyph.contours[0].points), "points", glyph.width
+
+        # thinning drops the state in between, the two segments become one
+        # and the next states go in that segment too
+        thinned = InterpolationEngine(maxStates=8)
+        thinned.addState(glyph)
+        thinned.addState(other)
+        for i in range(8):
+            glyph.width += 10
+            thinned.addState(glyph)
+        print "thinned segments:", thinned.segments()
+        assert thinned.segments() == [(0, len(thinned)-1)]
+
+    test()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import json
+import mmap
+import shutil
+import struct
+import tempfile
+import numpy
+
+from interpolatedStatesEngine import InterpolationEngine
+
+"""
+    Keep the recorded states of a font on disk, between sessions.
+
+    One binary file per font. A header, the arrays of the states one
+    after the other, and an index at the end, in json:
+
+        header      "ISTATES", format, offset and length of the index
+        arrays      the rows of the keyframes, the row indexes and rows
+                    of the states in between, as InterpolationEngine.entries()
+        index       for each key: the structures of the segments, the segment
+                    of each state, the fingerprints, the info and the offset
+                    and shape of each array
+
+    The file is memory mapped. Opening it reads the header and the index,
+    the arrays are views of the map, so only the pages of the states that
+    are made are read from disk. An engine with thousands of states
+    costs the index and the buffers.
+
+        history = HistoryFile(historyPath(font.path))
+        engine = history.engine("a")
+
+        writeHistory(historyPath(font.path), [("a", engine), ("b", otherEngine)])
+
+    The file is written next to the old one and moved in place, engines
+    that still map the old file keep working.
+
+"""
+
+_magic = "ISTATES"
+_formatVersion = 2
+_header = struct.Struct("<7sBQQ")
+_alignment = 8
+
+def historyPath(fontPath):
+    """ Where the states of the font at fontPath are kept, in the data dir of the ufo. """
+    return os.path.join(fontPath, "data", "com.letterror.interpolatedStates.bin")
+
+def _asTuple(value):
+    """ json makes lists of the structure tuples. """
+    if isinstance(value, list):
+        return tuple([_asTuple(item) for item in value])
+    return value
+
+def _keyToJSON(key):
+    if isinstance(key, tuple):
+        return list(key)
+    return key
+
+def writeHistory(path, engines, describe=None):
+    """ Write the states of the engines in a history file at path.
+        engines is a list of (key, engine), the key is a glyph name or a tuple of names.
+        describe(info) returns something for json for the info of each state.
+        Returns the number of bytes written.
+    """
+    dirName = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(dirName):
+        os.makedirs(dirName)
+    handle, tempPath = tempfile.mkstemp(dir=dirName)
+    f = os.fdopen(handle, "wb")
+    try:
+        f.write(_header.pack(_magic, _formatVersion, 0, 0))
+        offset = _header.size
+        index = []
+        for key, engine in engines:
+            if not len(engine):
+                continue
+            arrays = []
+            for changedRows, rows in engine.entries():
+                item = []
+                for array in (changedRows, rows):
+                    if array is None:
+                        item.append(None)
+                        continue
+                    padding = -offset % _alignment
+                    f.write("\0"*padding)
+                    offset += padding
+                    data = numpy.ascontiguousarray(array)
+                    f.write(data.tostring())
+                    item.append([offset, data.dtype.str, list(data.shape)])
+                    offset += data.nbytes
+                arrays.append(item)
+            info = engine.info
+            if describe is not None:
+                info = [describe(item) for item in info]
+            structures = []
+            segments = []
+            for first, last in engine.segments():
+                structures.append(engine.structures[first])
+                segments.extend([len(structures)-1]*(last-first+1))
+            index.append(dict(
+                key=_keyToJSON(key),
+                structures=structures,
+                segments=segments,
+                fingerprints=engine.fingerprints,
+                info=info,
+                arrays=arrays,
+                ))
+        indexData = json.dumps(index, separators=(",", ":"))
+        f.write(indexData)
+        f.seek(0)
+        f.write(_header.pack(_magic, _formatVersion, offset, len(indexData)))
+    finally:
+        f.close()
+    os.rename(tempPath, path)
+    return offset + len(indexData)
+
+class HistoryFile(object):
+    """
+
+        HistoryFile object
+
+            path                    the history file, see historyPath()
+            restore=None            restore(item) makes the info of a state from what
+                                    describe() made of it in writeHistory()
+
+        A file that is not there has no keys. The map stays open until close(),
+        the engines made from it read their states from the map.
+
+    """
+    def __init__(self, path, restore=None):
+        self.path = path
+        self.restore = restore
+        self._map = None
+        self._index = {}    # key: the json of the engine
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return
+        f = open(path, "rb")
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # the map keeps its own handle
+            f.close()
+        magic, formatVersion, indexOffset, indexLength = _header.unpack(self._map[:_header.size])
+        if magic != _magic or formatVersion != _formatVersion:
+            self.close()
+            raise ValueError("%s is not a history file I can read"%path)
+        for item in json.loads(self._map[indexOffset:indexOffset+indexLength]):
+            self._index[_asTuple(item["key"])] = item
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def _array(self, description):
+        if description is None:
+            return None
+        offset, dtype, shape = description
+        dtype = numpy.dtype(str(dtype))
+        count = 1
+        for size in shape:
+            count *= size
+        return numpy.frombuffer(self._map, dtype, count, offset).reshape(shape)
+
+    def load(self, key, engine):
+        """ Put the states of key in engine. Returns False if the file doesn't have them. """
+        item = self._index.get(key)
+        if item is None:
+            return False
+        entries = [(self._array(changedRows), self._array(rows)) for changedRows, rows in item["arrays"]]
+        info = item["info"]
+        if self.restore is not None:
+            info = [self.restore(value) for value in info]
+        structures = [_asTuple(structure) for structure in item["structures"]]
+        structures = [structures[segment] for segment in item["segments"]]
+        engine.loadEntries(structures, entries, info, item["fingerprints"])
+        return True
+
+    def engine(self, key, **engineOptions):
+        """ A new InterpolationEngine with the states of key, None if there are none. """
+        if key not in self._index:
+            return None
+        engine = InterpolationEngine(**engineOptions)
+        self.load(key, engine)
+        return engine
+
+    def close(self):
+        """ Let go of the map. Don't use the engines from this file after this. """
+        self._index = {}
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+if __name__ == "__main__":
+    def test():
+        """
+            Write a couple of engines and read them again.
+
+        """
+        import time
+        from interpolatedStatesEngine import StandInGlyph
+        dirName = tempfile.mkdtemp()
+        path = historyPath(os.path.join(dirName, "test.ufo"))
+        engines = []
+        for i in range(100):
+            glyph = StandInGlyph("g%d"%i, contours=[[(0, 0), (100, 0), (100, 100), (0, 100)]])
+            engine = InterpolationEngine(maxStates=1000)
+            for j in range(40):
+                glyph.contours[0].points[j%4].x += 10
+                glyph.width += 1
+                engine.addState(glyph, info=dict(t=j))
+            engines.append((glyph.name, engine))
+        print "written: %d bytes"%writeHistory(path, engines)
+        start = time.time()
+        history = HistoryFile(path)
+        print "opened %d glyphs in %3.5f sec"%(len(history), time.time()-start)
+        engine = history.engine("g50", maxStates=1000)
+        print "g50: %d states, %d bytes in memory"%(len(engine), engine.memory())
+        print "same states:", numpy.array_equal(engine.row(17), engines[50][1].row(17)), engine.info[17]
+        print "same blend:", numpy.array_equal(engine.blend(0.3).copy(), engines[50][1].blend(0.3))
+        history.close()
+        shutil.rmtree(dirName)
+
+    test()
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-__version__ = "0.21"
+__version__ = "0.25"
 
+import os
 import vanilla
-import time, math
-from AppKit import NSBeep
+import time
+from AppKit import NSApp, NSLeftMouseUp
+from PyObjCTools import AppHelper
 
 from mojo.events import addObserver, removeObserver
 
@@ -20,44 +22,76 @@ from mojo.events import addObserver, removeObserver
     the actual undo stack in RoboFont)
     
     The X button clears the states.
+    A state with other contours, points, anchors or components than the state
+    before starts a new segment. The slider blends within a segment and jumps
+    from one segment to the next.
+    The states are kept in the data dir of the ufo when the window closes,
+    and are there again the next time.
+    
+    Use 'A' (shift a) to record the selected glyphs of the font as one state,
+    or all the glyphs in the layer when none are selected. The slider then
+    interpolates all of them, until the X button goes back to the current glyph.
+    
+    The interpolation itself is in interpolatedStatesEngine.py,
+    this is the window and the observers around it.
+    
+    InterpolatedStateTool(timing=True) keeps the times of recording a state
+    and of the slider, and prints the percentiles when the window closes.
+    interpolatedStatesBenchmark.py measures the same without RoboFont.
     
     Erik van Blokland
     Frederik Berlaen.   
     
 """
 
-from robofab.pens.digestPen import DigestPointPen
-from fontMath.mathGlyph import MathGlyph
+from interpolatedStatesHistory import HistoryFile, historyPath, writeHistory
+from interpolatedStatesEngine import InterpolationEngine, FrameCache, StateStore, SliderScheduler, StageTimer, GlyphGroup, readGlyph, writeGlyph, fingerprint
 
 class GlyphState(object):
-    def __init__(self, glyph, soft=False):
-        p = DigestPointPen(ignoreSmoothAndName=True)
-        glyph.drawPoints(p)
-        self.digest = p.getDigest()
-        self.glyph = MathGlyph(glyph)
+    def __init__(self, glyph, soft=False, glyphFingerprint=None):
+        if glyphFingerprint is None:
+            glyphFingerprint = fingerprint(*readGlyph(glyph))
+        self.fingerprint = glyphFingerprint
         self.t = time.time()
         self.name = glyph.name
         self.soft = soft
     
+    def asDict(self):
+        return dict(t=self.t, name=self.name, soft=self.soft)
+    
+    @classmethod
+    def fromDict(cls, data):
+        state = cls.__new__(cls)
+        state.fingerprint = None
+        state.t = data["t"]
+        state.name = data["name"]
+        state.soft = data["soft"]
+        return state
+    
     def breakCycles(self):
         # not sure if we need to be so explicit
         # but it will happen a lot, so might as well be safe.
-        self.glyph = None
-        self.digest = None
+        self.fingerprint = None
         
     def __repr__(self):
         return "<GlyphState for %s %3.3f>"%(self.name, self.t)
     
-    def getDigest(self):
-        return self.digest
-        
-    def getGlyph(self):
-        return self.glyph
-    
 class InterpolatedStateTool(object):
-    def __init__(self):
-        self._states = []
-        self._lastState = None    # place for the last state before we start interpolating
+    def __init__(self, timing=False):
+        self.timer = StageTimer(enabled=timing)
+        self.store = StateStore(load=self._loadHistory, evicted=self._evicted)   # the states of each glyph we recorded states for
+        self._histories = {}      # font path: HistoryFile with the states of earlier sessions
+        self._oldHistories = []   # HistoryFiles that were written again, engines can still read from them
+        self._savedVersions = {}  # store key: the version of its engine that is in the history file
+        self._loadedFrom = {}     # store key: the HistoryFile its engine reads from
+        self._cleared = set()     # store keys that were cleared, they don't go back in the file
+        self.engine = InterpolationEngine()     # the states of this glyph, engine.info has their GlyphStates
+        self.frames = FrameCache(self.engine)   # the slider positions we have been to
+        self.scheduler = SliderScheduler(self._sliderFrame, self._applyFrame, self._callLater, timer=self.timer)
+        self._glyphKey = None
+        self._group = None        # the GlyphGroup when we record more than one glyph
+        self._needEnd = True      # take the glyph as it is before we start interpolating
+        self._shownStructure = None   # the structure of the glyph in the window, None when we don't know
         self._lastName = ""
         self._currentGlyph = None
         height = 32
@@ -83,26 +117,50 @@ class InterpolatedStateTool(object):
         
     def reportStatus(self, text=None):
         if text is None:
-            l = len(self._states)
+            l = len(self.engine)
             plural = ""
             if l == 0 or l > 1:
                 plural = "s"
             title = "%d state%s recorded"%(l, plural)
+            segments = len(self.engine.segments())
+            if segments > 1:
+                title = "%s, %d segments"%(title, segments)
+            if self._group is not None:
+                title = "%s, %s"%(title, self._group.name)
             self.w.setTitle(title)
         else:
             self.w.setTitle(text)
     
     def currentGlyphChanged(self, notification):
+        if self._group is not None:
+            # the group stays until it is cleared
+            return
         if not (notification["glyph"] == self._currentGlyph):
             self.subscribeGlyph()
         
     def keyDown(self, notification):
-        if notification["event"].characters() == "a":
+        characters = notification["event"].characters()
+        if characters == "a":
             self.saveState()
+        elif characters == "A":
+            self.saveGroupState()
     
     def bindingWindowClosed(self, sender):
-        for item in self._states:
-            item.breakCycles()
+        self.scheduler.stop()
+        try:
+            self._saveHistories()
+        except:
+            import traceback
+            print traceback.format_exc(5)
+        for history in self._histories.values() + self._oldHistories:
+            if history is not None:
+                history.close()
+        if self.timer.enabled:
+            print "Interpolated State times in ms"
+            print self.timer.report()
+        for engine in self.store.engines():
+            for item in engine.info:
+                item.breakCycles()
         removeObserver(self, "currentGlyphChanged")
         removeObserver(self, "keyDown")
     
@@ -110,52 +168,203 @@ class InterpolatedStateTool(object):
     #    self.subscribeGlyph()
         
     def subscribeGlyph(self):
-        for item in self._states:
-            item.breakCycles()
-        self._states = []
+        # Nothing is recorded here, switching glyphs happens all the time.
+        # The states of each glyph stay in the store.
+        self.scheduler.cancel()
         self._currentGlyph = g = CurrentGlyph()
+        self._needEnd = True
+        self._shownStructure = None
+        engine = None
         if g is None:
-            self._lastState = None
+            self._glyphKey = None
             self._lastName = ""
         else:
-            s = GlyphState(g, soft=True)
-            if len(self._states)>1:
-                
-                if self._states[-1].digest != s.digest:
-                   if self._states[-1].soft:
-                       self._states = self._states[:-1]
-                       self._states.append(s)
-                   else:
-                       self._states.append(s)
-                    
-            self._lastState = s
+            self._glyphKey = self._storeKey(g)
             self._lastName = g.name
-
-        if len(self._states)==0:
+            engine = self.store.engine(self._glyphKey, create=False)
+        if engine is None:
+            engine = InterpolationEngine()
+        self.engine = engine
+        self.frames = FrameCache(engine)
+        if len(self.engine)==0:
             self.w.clearButton.enable(False)
+            self.w.interpolateSlider.enable(False)
+            self.reportStatus("Add a glyph.")
         else:
             self.w.clearButton.enable(True)
+            self.w.interpolateSlider.enable(True)
+            self.reportStatus()
+    
+    def _history(self, fontPath):
+        if fontPath is None:
+            return None
+        if fontPath not in self._histories:
+            try:
+                self._histories[fontPath] = HistoryFile(historyPath(fontPath), restore=GlyphState.fromDict)
+            except:
+                import traceback
+                print traceback.format_exc(5)
+                self._histories[fontPath] = None
+        return self._histories[fontPath]
+    
+    def _loadHistory(self, key, **engineOptions):
+        # the store asks for the glyphs it doesn't have, with the options for its engines
+        if key in self._cleared:
+            return None
+        fontPath, name = key
+        history = self._history(fontPath)
+        if history is None:
+            return None
+        engine = history.engine(name, **engineOptions)
+        if engine is not None:
+            self._savedVersions[key] = engine.version
+            self._loadedFrom[key] = history
+        return engine
+    
+    def _saveHistories(self):
+        # Write the states of each font: the glyphs in the store,
+        # and the glyphs from the file that were not used this time.
+        fontPaths = set([fontPath for fontPath, name in self.store.keys()])
+        fontPaths.update(self._histories.keys())
+        for fontPath in fontPaths:
+            if self._historyChanged(fontPath):
+                self._saveHistory(fontPath)
+    
+    def _historyChanged(self, fontPath):
+        # True if a glyph of the font has states the file doesn't have, or was cleared
+        for key in self.store.keys():
+            if key[0] == fontPath and key not in self._cleared \
+                    and self._savedVersions.get(key) != self.store.get(key).version:
+                return True
+        history = self._histories.get(fontPath)
+        if history is not None:
+            for key in self._cleared:
+                if key[0] == fontPath and key[1] in history:
+                    return True
+        return False
+    
+    def _saveHistory(self, fontPath, evicted=()):
+        # evicted is a list of (name, engine) the store just let go of
+        if fontPath is None or not os.path.exists(fontPath):
+            return False
+        engines = list(evicted)
+        names = set([name for name, engine in evicted])
+        for key in self.store.keys():
+            if key[0] == fontPath and key not in self._cleared:
+                engines.append((key[1], self.store.get(key)))
+                names.add(key[1])
+        history = self._history(fontPath)
+        if history is not None:
+            for name in history.keys():
+                if name not in names and (fontPath, name) not in self._cleared:
+                    engines.append((name, history.engine(name)))
+        if not engines and (history is None or not len(history)):
+            return False
+        writeHistory(historyPath(fontPath), engines, describe=GlyphState.asDict)
+        for key in self.store.keys():
+            if key[0] == fontPath and key not in self._cleared:
+                self._savedVersions[key] = self.store.get(key).version
+        return True
+    
+    def _evicted(self, key, engine):
+        # The store lets go of a glyph. If it has states the file doesn't have,
+        # write them now or the file keeps the ones from before.
+        savedVersion = self._savedVersions.pop(key, None)
+        self._loadedFrom.pop(key, None)
+        if key not in self._cleared and len(engine) and savedVersion != engine.version:
+            try:
+                fontPath, name = key
+                if self._saveHistory(fontPath, [(name, engine)]):
+                    history = self._histories.pop(fontPath, None)
+                    if history is not None:
+                        # the engines in the store can still read from the old map
+                        self._oldHistories.append(history)
+            except:
+                import traceback
+                print traceback.format_exc(5)
+        for item in engine.info:
+            item.breakCycles()
+        self._closeOldHistories()
+    
+    def _closeOldHistories(self):
+        # an old map can go when no engine in the store reads from it
+        inUse = [self._loadedFrom[key] for key in self.store.keys() if key in self._loadedFrom]
+        for history in list(self._oldHistories):
+            if history not in inUse:
+                history.close()
+                self._oldHistories.remove(history)
+    
+    def _storeKey(self, glyph):
+        font = glyph.getParent()
+        if font is None:
+            return None, glyph.name
+        return font.path, glyph.name
+    
+    def subscribeGroup(self):
+        # the selected glyphs of the current font, or all of them
+        font = CurrentFont()
+        if font is None:
+            return False
+        names = font.selection
+        if not names:
+            names = font.keys()
+        self.scheduler.cancel()
+        self._group = GlyphGroup([font[name] for name in sorted(names)])
+        self._glyphKey = font.path, self._group.names
+        self._needEnd = True
+        self._shownStructure = None
+        engine = self.store.engine(self._glyphKey, create=False)
+        if engine is None:
+            engine = InterpolationEngine()
+        self.engine = engine
+        self.frames = FrameCache(engine)
+        return True
+    
+    def saveGroupState(self):
+        if self._group is None and not self.subscribeGroup():
+            return
+        self.saveState()
     
     def saveState(self):
         try:
-            if self._currentGlyph is None:
+            if self._currentGlyph is None and self._group is None:
                 return    
-            state = GlyphState(self._currentGlyph)
-            if len(self._states)>0:
-                if state.digest == self._states[-1].digest:
-                    # already got this one, thanks.
-                    return
-            self._states.append(state)
+            self.scheduler.cancel()
+            engine = self.store.engine(self._glyphKey)
+            self._cleared.discard(self._glyphKey)
+            if engine is not self.engine:
+                # the first state of this glyph
+                self.engine = engine
+                self.frames = FrameCache(engine)
+            with self.timer.time("capture"):
+                if self._group is None:
+                    source = self._currentGlyph
+                    structure, coordinates = readGlyph(source)
+                else:
+                    # one state for all the glyphs in the group
+                    source = self._group
+                    structure, coordinates = source.read()
+                state = GlyphState(source, glyphFingerprint=fingerprint(structure, coordinates))
+            if self.engine.find(structure, coordinates, state.fingerprint, last=True) is not None:
+                # already got this one, thanks.
+                return
+            # old states are thinned out when there are too many
+            # different points start a new segment
+            with self.timer.time("record"):
+                self.engine.addCoordinates(structure, coordinates, state, state.fingerprint)
+            self.store.trim()
+            self._needEnd = True
+            # the glyph can be edited before the next drag
+            self._shownStructure = None
             self.w.clearButton.enable(True)
             self.reportStatus()
-            if len(self._states)>0:
+            if len(self.engine)>0:
                 self.w.interpolateSlider.enable(True)
             else:
                 self.w.interpolateSlider.enable(False)
         except:
             import traceback
             print traceback.format_exc(5)
-            self._lastState = None
             self.w.interpolateSlider.enable(False)
             self.w.clearButton.enable(False)
             self.w.saveButton.enable(False)
@@ -165,17 +374,25 @@ class InterpolatedStateTool(object):
         self.saveState()
 
     def callbackClearButton(self, sender):
-        self._states = []
+        self.scheduler.cancel()
+        self.engine.clear()
+        self.store.discard(self._glyphKey)
+        self._cleared.add(self._glyphKey)
+        self._savedVersions.pop(self._glyphKey, None)
+        self._loadedFrom.pop(self._glyphKey, None)
+        self._closeOldHistories()
+        self._needEnd = True
+        self._shownStructure = None
         self.reportStatus()
         self.w.clearButton.enable(False)
         self.w.interpolateSlider.set(100)
         self.w.interpolateSlider.enable(False)
         self.reportStatus("Add a glyph.")
+        if self._group is not None:
+            # back to the current glyph
+            self._group = None
+            self.subscribeGlyph()
     
-    def _interpolate(self, a, b, factor):
-        r = a + factor*(b-a)
-        return True, r
-        
     def callbackInterpolateSlider(self, sender):
         """ This interpolates between all the states in sequence. 
             The last state before we started sliding is the 100%
@@ -190,42 +407,59 @@ class InterpolatedStateTool(object):
             0            f                      1    factor
             
             """
-        stateCount = len(self._states)
-        factor = sender.get()*0.01
-        final = None
-        length = len(self._states)-1
-        ok = False
-        if stateCount==1:
-            a = self._states[0].getGlyph()
-            b = self._lastState.getGlyph()
-            ok, final = self._interpolate(a, b, factor)
-        else:
-
-            if factor == 0:
-                # get the oldest
-                final = self._states[0].getGlyph()
-                ok = True
-            elif factor == 1:
-                # get the newest
-                final = self._states[-1].getGlyph()
-                ok = True
+        if self._shownStructure is None or (self._needEnd and len(self.engine)==1):
+            # Read the glyph once, not for every value. The frames know their structure,
+            # from here on we know when the glyph has to be drawn again.
+            self.scheduler.cancel()
+            if self._group is None:
+                structure, coordinates = readGlyph(self._currentGlyph)
             else:
-                prevIdx = int(math.floor(length*factor))
-                nextIdx = prevIdx+1
-                m1 = prevIdx/float(length)
-                m2 = nextIdx/float(length)
-
-                a = self._states[prevIdx].getGlyph()
-                b = self._states[nextIdx].getGlyph()
-                relativeFactor = (factor-m1)/ (m2-m1)
-
-                ok, final = self._interpolate(a, b, relativeFactor)
-        if not ok:
-            return False
-        # Now we need to apply the resulting mathglyph to the glyph in the window.
+                structure, coordinates = self._group.read()
+            self._shownStructure = structure
+            if self._needEnd and len(self.engine)==1:
+                # with one state we go from that state to the glyph as it is now
+                self.engine.setEndCoordinates(structure, coordinates)
+                self._needEnd = False
+        # A drag sends more values than we can draw. The scheduler makes the frame
+        # of the newest value in a thread and draws it at most 30 times a second.
+        # When the mouse goes up the last value is drawn right away.
+        event = NSApp().currentEvent()
+        if event is not None and event.type() == NSLeftMouseUp:
+            self.scheduler.finish(sender.get())
+            # the glyph can be edited before the next drag
+            self._shownStructure = None
+        else:
+            self.scheduler.request(sender.get())
+    
+    def _sliderFrame(self, value):
+        # The frames are kept for each whole slider value, until the states change.
+        frame = self.frames.frame(value)
+        if frame is None:
+            return None
+        return self.frames.structure(value), frame
+    
+    def _applyFrame(self, item):
+        # Now we need to apply the result to the glyph in the window.
         # Note: we're actually drawing in the currentglyph. Undo will be affected.
-        final.extractGlyph(self._currentGlyph)
-        self._currentGlyph.deselect()          
+        structure, frame = item
+        newStructure = None
+        if structure is not self._shownStructure:
+            if structure != self._shownStructure:
+                # another segment, the glyph is drawn again
+                newStructure = structure
+            self._shownStructure = structure
+        if self._group is not None:
+            # only the glyphs that moved since the last frame are written
+            self._group.write(frame, newStructure)
+            return
+        if self._currentGlyph is None:
+            return
+        writeGlyph(self._currentGlyph, frame, newStructure)
+        self._currentGlyph.deselect()
+    
+    def _callLater(self, delay, function):
+        # callLater needs the run loop of the main thread, the worker doesn't have one.
+        AppHelper.callAfter(AppHelper.callLater, delay, function)
     
 if __name__ == "__main__":
     ist = InterpolatedStateTool()